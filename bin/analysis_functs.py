@@ -10,11 +10,13 @@ import matplotlib.pyplot as plt
 import math
 
 # from casatasks import uvmodelfit
-import datetime
 import os
 
 from casacore.tables import table
 import fitfuncts
+import msio
+import uvfit
+import lcstore
 import CFigTools.CustomFigure as CF
 import priortransfuncts
 
@@ -286,21 +288,6 @@ def calc_secbayes(avg_logz):
     return
 
 
-def read_timeranges(start_times, end_times):
-    timeranges = []
-    for i in range(len(start_times)):
-        start_time = datetime.datetime.strptime(start_times[i], "%H:%M:%S")
-        end_time = datetime.datetime.strptime(end_times[i], "%H:%M:%S")
-        new_time = start_time
-        current_time = start_time
-        timeranges.append(start_times[i])
-        while new_time < end_time:
-            new_time = new_time + datetime.timedelta(0, 30)
-            current_str = new_time.strftime("%H:%M:%S")
-            timeranges.append(current_str)
-    return timeranges
-
-
 def plt_alphatime(
     save_dir,
     alpha,
@@ -473,40 +460,51 @@ def plt_peakftime(
     return
 
 
-# def read_lightcurveflux(data_dir, outfile_dir, timeranges):
-#     fluxes = []
-#     err_fluxes = []
-#     for i in range(len(timeranges)):
-#         timerange = f"{timeranges[i]}+00:00:30"
-#         outfile = f"{outfile_dir}_{timerange}.cl"
-#         tar_ms = f"{data_dir}_selfcal.ms"
-#         print(tar_ms)
-#         if (os.path.exists(outfile)) is False:
-#             uvmodelfit(
-#                 vis=tar_ms,
-#                 niter=10,
-#                 comptype="P",
-#                 outfile=outfile,
-#                 field="0",
-#                 selectdata=True,
-#                 timerange=timerange,
-#             )
-#             tbl = table(outfile)
-#             flux = tbl.getcell("Flux", 0)[0].astype("float64")
-#             err = np.sqrt((flux * 0.05) ** 2 + (0.002 ** 2))
-#             fluxes.append(flux)
-#             err_fluxes.append(err)
-#         else:
-#             tbl = table(outfile)
-#             flux = tbl.getcell("Flux", 0)[0].astype("float64")
-#             err = np.sqrt((0.002 ** 2))# + (flux * 0.05) ** 2)
-#             fluxes.append(flux)
-#             err_fluxes.append(err)
-#     print(np.std(fluxes)/np.median(fluxes))
-#     mod = round(np.std(fluxes)/np.median(fluxes), -int(math.floor(math.log10(abs(np.std(fluxes)/np.median(fluxes))))))
-#     err_fluxes = (err_fluxes/np.median(fluxes))*100
-#     fluxes = ((fluxes/np.median(fluxes)) - 1)*100
-#     return fluxes, err_fluxes, mod
+def lightcurve_bins(data_dir, field="0", interval=30.0, skip_scans=()):
+    # The 30 s bins of every scan on field, read off {data_dir}_selfcal.ms instead of typing in scan times.
+    # skip_scans: times (HH:MM:SS) within scans to leave out. Returns the bin starts (datetime64), ready for
+    # read_lightcurveflux, and minutes since the first scan for plotting.
+    tar_ms = f"{data_dir}_selfcal.ms"
+    windows = msio.scan_windows(tar_ms, field=field)
+    day = msio.first_day(tar_ms)
+    keep = np.ones(len(windows["start"]), dtype=bool)
+    for skip in skip_scans:
+        skip_time = msio.parse_casa_time(skip, day)
+        keep &= ~((windows["start"] <= skip_time) & (windows["end"] >= skip_time))
+    bins = msio.scan_bins({key: val[keep] for key, val in windows.items()}, interval)
+    return bins["start"], bins["minutes"]
+
+
+def read_lightcurveflux(data_dir, outfile_dir, timeranges, interval=30.0):
+    # Flux in each 30 s bin starting at timeranges (HH:MM:SS or datetime64, e.g. from lightcurve_bins), all fit in one
+    # read of the ms by uvfit.lightcurve_ms rather than a uvmodelfit per bin.
+    # Returns % deviations from the median, their errors and the modulation index.
+    # Fits are kept in {outfile_dir}_lightcurve.npz, so only bins that aren't in there yet get fit.
+    tar_ms = f"{data_dir}_selfcal.ms"
+    print(tar_ms)
+    timeranges = np.asarray(timeranges)
+    if np.issubdtype(timeranges.dtype, np.datetime64):
+        starts = [float(start) for start in msio.datetime64_to_mjds(timeranges)]
+    else:
+        day = msio.first_day(tar_ms)
+        starts = [float(msio.datetime64_to_mjds(msio.parse_casa_time(start, day))) for start in timeranges]
+    store_file = lcstore.store_path(outfile_dir)
+    # Settings the bins are fit with, kept with the store so a change to them refits everything
+    settings = {"field": "0", "sourcepar": [1.0, 0.0, 0.0], "vary_offset": True}
+    meta = lcstore.fit_meta(tar_ms, **settings)
+    store = lcstore.load(store_file, meta)
+    todo = [start for start, row in zip(starts, lcstore.find(store, starts, interval)) if row < 0]
+    if todo:
+        print(f"Fitting {len(todo)} of {len(starts)} bins")
+        lightcurve = uvfit.lightcurve_ms(tar_ms, interval=interval, starts=todo, **settings)
+        store = lcstore.append(store_file, store, lcstore.from_fit(lightcurve), meta)
+    fluxes = store["flux"][lcstore.find(store, starts, interval)]
+    err_fluxes = np.sqrt((fluxes * 0.05) ** 2 + (0.002 ** 2))
+    print(np.nanstd(fluxes)/np.nanmedian(fluxes))
+    mod = round(np.nanstd(fluxes)/np.nanmedian(fluxes), -int(math.floor(math.log10(abs(np.nanstd(fluxes)/np.nanmedian(fluxes))))))
+    err_fluxes = (err_fluxes/np.nanmedian(fluxes))*100
+    fluxes = ((fluxes/np.nanmedian(fluxes)) - 1)*100
+    return fluxes, err_fluxes, mod
 
 
 def plt_lightcurve_continual(
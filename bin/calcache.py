@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# Cache of solved calibration tables, shared between targets that use the same primary/secondary.
+# Tables are stored under a key made from the calibrator rows of the ms (times, baselines, spws, flags)
+# and every solver parameter, so a hit means gaincal/bandpass/fluxscale would produce the same tables again.
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from casacore.tables import table
+import msio
+import workspace
+
+
+def cal_key(msname, fields, params):
+    # fields: calibrator field names, params: everything else that goes into the solutions
+    h = hashlib.sha1()
+    h.update(json.dumps({"fields": fields, "params": params}, sort_keys=True).encode())
+    t = table(msname, ack=False)
+    field_ids = msio.field_ids(msname, ",".join(fields))
+    columns = ["TIME", "ANTENNA1", "ANTENNA2", "DATA_DESC_ID", "FLAG"]
+    for sub, start, nrow, cols in msio.iter_chunks(t, msname, columns, field=field_ids):
+        for col in columns[:-1]:
+            h.update(np.ascontiguousarray(cols[col]).tobytes())
+        h.update(np.packbits(cols["FLAG"]).tobytes())
+    t.close()
+    return h.hexdigest()
+
+
+def lookup(cache_dir, key, names):
+    # Directory holding every one of the named tables for this key, or None on a miss
+    entry = f"{cache_dir}/{key}"
+    if all(os.path.exists(f"{entry}/{name}") for name in names):
+        return entry
+    return None
+
+
+def staging_dir(cache_dir, key):
+    # Somewhere to solve into, published in one go by publish() so other jobs never see half a set of tables
+    tmp = f"{cache_dir}/{key}.tmp{os.getpid()}"
+    workspace.remove(tmp)
+    os.makedirs(tmp)
+    return tmp
+
+
+def publish(cache_dir, key, tmp, names):
+    # Moves the solved tables into place as the entry for key, which then holds every one of names
+    entry = f"{cache_dir}/{key}"
+    missing = [name for name in names if not os.path.exists(f"{tmp}/{name}")]
+    if missing:
+        raise RuntimeError(f"Can't cache calibration tables {key}, {', '.join(missing)} weren't solved")
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        if lookup(cache_dir, key, names) is not None:
+            # Another job solved the same tables first, theirs are just as good
+            shutil.rmtree(tmp, ignore_errors=True)
+            return entry
+        # An entry left incomplete (e.g. by an interrupted run) is moved aside and replaced
+        stale = f"{entry}.stale{os.getpid()}"
+        os.rename(entry, stale)
+        os.rename(tmp, entry)
+        shutil.rmtree(stale, ignore_errors=True)
+    return entry
+
+
+def link_tables(entry, names, dest_dir):
+    # Point {dest_dir}/{name} at the cached tables, replacing whatever was there
+    for name in names:
+        dest = f"{dest_dir}/{name}"
+        workspace.remove(dest)
+        os.symlink(os.path.abspath(f"{entry}/{name}"), dest)
+    return
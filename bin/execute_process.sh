@@ -7,12 +7,30 @@ EPOCH=FALSE
 BAND=C
 TARGET=J001513
 CALIBRATOR=TAR
+# Comma separated stages to consider (empty for all), and stages to rerun even if up to date
+STEPS=
+FORCE=
+# Batch mode: comma separated TARGET:BAND jobs (or TARGET=ALL) run MAXJOBS at a time, each in its own dir under SCRATCH
+JOBS=
+MAXJOBS=2
+SCRATCH=${PROJECT}processing/scratch
+# Number of spws to image in parallel within each job
+IMGWORKERS=1
+# Fast local disk for the imaging intermediates (.psf, .residual, .pb, .sumwt), empty to keep everything in casa_files
+STAGING=
 
 export PROJECT
 export EPOCH
 export BAND
 export TARGET
 export CALIBRATOR
+export STEPS
+export FORCE
+export JOBS
+export MAXJOBS
+export SCRATCH
+export IMGWORKERS
+export STAGING
 
 cd $PROJECT/processing/
 
@@ -37,58 +37,10 @@ for i in range(len(gleam_targets)):
     avg_logz_src = np.array(avg_logz_src)
     avg_logz[gleam_tar] = np.around(avg_logz_src, decimals=1)
     if target == "J215436":
-        start_times = [
-            "09:37:44",
-            "10:41:28",
-            # "10:54:16",
-            # "11:41:12",
-            "11:54:00",
-            # "12:40:56",
-            "12:53:44",
-            # "13:40:40",
-            # "13:53:28",
-            "14:40:48",
-            "14:53:52",
-        ]
-        end_times = [
-            "09:47:13",
-            "10:50:47",
-            # "11:03:45",
-            # "11:50:41",
-            "12:03:29",
-            # "12:50:25",
-            "13:03:13",
-            # "13:50:09",
-            # "14:02:57",
-            "14:50:17",
-            "15:03:21",
-        ]
-        timeranges_215436 = analysis_functs.read_timeranges(start_times, end_times)
-        scan_times_arr = np.arange(0, 10, 0.5)
-        scan_times_arr2 = np.arange(64, 74, 0.5)
-        # scan_times_arr3 = np.arange(77, 87, 0.5)
-        # scan_times_arr4 = np.arange(124, 134, 0.5)
-        scan_times_arr5 = np.arange(137, 147, 0.5)
-        # scan_times_arr6 = np.arange(183, 193, 0.5)
-        scan_times_arr7 = np.arange(196, 206, 0.5)
-        scan_times_arr8 = np.arange(243, 253, 0.5)
-        scan_times_arr9 = np.arange(256, 266, 0.5)
-        scan_times_arr10 = np.arange(303, 313, 0.5)
-        scan_times_arr11 = np.arange(316, 326, 0.5)
-        scan_times = np.concatenate(
-            (
-                scan_times_arr,
-                scan_times_arr2,
-                # scan_times_arr3,
-                # scan_times_arr4,
-                scan_times_arr5,
-                # scan_times_arr6,
-                scan_times_arr7,
-                # scan_times_arr8,
-                # scan_times_arr9,
-                scan_times_arr10,
-                scan_times_arr11,
-            )
+        # Scans and their 30 s bins are read from the ms, only the scans to leave out are listed
+        timeranges_215436, scan_times = analysis_functs.lightcurve_bins(
+            f"{data_dir}data/epoch5_X_{target}",
+            skip_scans=["10:54:16", "11:41:12", "12:40:56", "13:40:40", "13:53:28"],
         )
         outfile_dir = (
             f"/data/ATCA/ATCA_datareduction/J215436/casa_files/{target}_X_epoch5"
@@ -115,46 +67,9 @@ for i in range(len(gleam_targets)):
         mod_j215436 = np.stack((mod_j215436_c, mod_j215436_x))
         # print(len(timeranges_215436))
 
-        start_times_sec = [
-            "09:35:20",
-            "09:48:08",
-            "10:39:04",
-            "10:51:52",
-            # "11:04:40",
-            # "11:38:48",
-            "11:51:36",
-            "12:04:24",
-            # "12:38:32",
-            "12:51:20",
-            "13:04:08",
-            # "13:38:16",
-            # "13:51:04",
-            # "14:03:52",
-            "14:38:16",
-            "14:51:20",
-            "15:04:32",
-        ]
-        end_times_sec = [
-            "09:36:49",
-            "09:49:37",
-            "10:40:33",
-            "10:53:21",
-            # "11:06:09",
-            # "11:40:17",
-            "11:53:05",
-            "12:05:53",
-            # "12:40:01",
-            "12:52:49",
-            "13:05:37",
-            # "13:39:45",
-            # "13:52:33",
-            # "14:05:21",
-            "14:39:45",
-            "14:52:49",
-            "15:06:01",
-        ]
-        timeranges_215436_sec = analysis_functs.read_timeranges(
-            start_times_sec, end_times_sec
+        timeranges_215436_sec, scan_times_sec = analysis_functs.lightcurve_bins(
+            f"{data_dir}data/epoch5_X_2211-388",
+            skip_scans=["11:04:40", "11:38:48", "12:38:32", "13:38:16", "13:51:04", "14:03:52"],
         )
         outfile_dir = (
             f"/data/ATCA/ATCA_datareduction/J215436/casa_files/2211-388_X_epoch5"
@@ -166,27 +81,6 @@ for i in range(len(gleam_targets)):
         ) = analysis_functs.read_lightcurveflux(
             f"{data_dir}data/epoch5_X_2211-388", outfile_dir, timeranges_215436_sec
         )
-        scan_times_sec = np.concatenate(
-            (
-                np.arange(0, 2, 0.5),
-                np.arange(13, 15, 0.5),
-                np.arange(64, 66, 0.5),
-                np.arange(76, 78, 0.5),
-                # np.arange(89, 91, 0.5),
-                # np.arange(123, 125, 0.5),
-                np.arange(136, 138, 0.5),
-                np.arange(149, 151, 0.5),
-                # np.arange(183, 185, 0.5),
-                np.arange(196, 198, 0.5),
-                np.arange(209, 211, 0.5),
-                # np.arange(243, 245, 0.5),
-                # np.arange(256, 258, 0.5),
-                # np.arange(268, 270, 0.5),
-                np.arange(303, 305, 0.5),
-                np.arange(316, 318, 0.5),
-                np.arange(329, 331, 0.5),
-            )
-        )
         outfile_dir = (
             f"/data/ATCA/ATCA_datareduction/J215436/casa_files/2211-388_C_epoch5"
         )
@@ -218,9 +112,9 @@ for i in range(len(gleam_targets)):
     if target == "J001513":
         plt.close()
         plt.clf()
-        start_times = ["17:53:00", "19:31:30"]
-        end_times = ["18:02:20", "19:40:50"]
-        timeranges_001513 = analysis_functs.read_timeranges(start_times, end_times)
+        timeranges_001513, scan_times_001513 = analysis_functs.lightcurve_bins(
+            f"{data_dir}data/2021-10-15_C_{target}"
+        )
         outfile_dir = (
             f"/data/ATCA/ATCA_datareduction/J020507/casa_files/{target}_C_2021-10-15"
         )
@@ -245,9 +139,9 @@ for i in range(len(gleam_targets)):
         err_fluxes_j001513 = np.stack((err_fluxes_j001513_c, err_fluxes_j001513_x))
         mod_j001513 = np.stack((mod_j001513_c, mod_j001513_x))
     elif target == "J020507":
-        start_times = ["17:01:50", "18:46:10"]
-        end_times = ["17:11:20", "18:55:40"]
-        timeranges_020507 = analysis_functs.read_timeranges(start_times, end_times)
+        timeranges_020507, scan_times_020507 = analysis_functs.lightcurve_bins(
+            f"{data_dir}data/2021-10-15_C_{target}"
+        )
         outfile_dir = (
             f"/data/ATCA/ATCA_datareduction/J020507/casa_files/{target}_C_2021-10-15"
         )
@@ -271,11 +165,8 @@ for i in range(len(gleam_targets)):
         # fluxes_j020507 = np.stack((fluxes_j020507_c, fluxes_j020507_x))
         # err_fluxes_j020507 = np.stack((err_fluxes_j020507_c, err_fluxes_j020507_x))
         # mod_j020507 = np.stack((mod_j020507_c, mod_j020507_x))
-        # scan_times_arr = np.arange(0, 10, 0.5)
-        # scan_times_0015_2 = np.arange(98.5, 108.5, 0.5)
-        # scan_times_0205_2 = np.arange(104.3333333, 114.3333333, 0.5)
-        # scan_times_src1 = np.stack((scan_times_arr, scan_times_0015_2))
-        # scan_times_src2 = np.stack((scan_times_arr, scan_times_0205_2))
+        # scan_times_src1 = scan_times_001513.reshape(2, -1)
+        # scan_times_src2 = scan_times_020507.reshape(2, -1)
         # print("plotting!!!!")
         # analysis_functs.plt_lightcurve(
         #     f"{save_dir}Plots/",
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# Online flagging (shadowing, zero/NaN clipping and quacking the start of each scan) in one pass over the ms,
+# instead of one flagdata pass per mode. Shadowed and quacked rows are worked out from the metadata columns first,
+# then DATA and FLAG are streamed through once in row chunks and FLAG is written back once.
+# Gives the same flags as flagdata mode="shadow", mode="clip" with clipzeros=True and mode="quack" (quackmode="beg").
+# Also an RFlag style flagger for the calibrated data that streams every calibrator and target field through in
+# chunks of bounded size, rather than flagdata mode="rflag" loading a whole field per call.
+
+import warnings
+import numpy as np
+from casacore.tables import table
+import msio
+
+
+def antenna_uvw(times, ant1, ant2, uvw, nant):
+    # Per antenna uvw at every time, up to an offset per time, from the baseline uvws (in CASA UVW is
+    # uvw(ANTENNA1) - uvw(ANTENNA2)). Times with the same set of baselines share one least squares solution.
+    # Returns the unique times and an array (time, antenna, 3), nan for antennas with no baselines at that time.
+    order = np.lexsort((ant2, ant1, times))
+    times, ant1, ant2, uvw = times[order], ant1[order], ant2[order], uvw[order]
+    utimes, first, counts = np.unique(times, return_index=True, return_counts=True)
+    ant_uvw = np.full((len(utimes), nant, 3), np.nan)
+    baselines = ant1.astype(np.int64) * nant + ant2
+    layouts = {}
+    for itime, (start, count) in enumerate(zip(first, counts)):
+        layouts.setdefault(baselines[start:start + count].tobytes(), []).append(itime)
+    for itimes in layouts.values():
+        itimes = np.array(itimes)
+        count = counts[itimes[0]]
+        a1 = ant1[first[itimes[0]]:first[itimes[0]] + count]
+        a2 = ant2[first[itimes[0]]:first[itimes[0]] + count]
+        present = np.unique(np.concatenate([a1, a2]))
+        incidence = np.zeros((count, nant))
+        incidence[np.arange(count), a1] = 1.0
+        incidence[np.arange(count), a2] = -1.0
+        solve = np.linalg.pinv(incidence[:, present])
+        rows = first[itimes][:, None] + np.arange(count)
+        ant_uvw[itimes[:, None], present] = np.einsum("ab,tbk->tak", solve, uvw[rows])
+    return utimes, ant_uvw
+
+
+def shadowed_antennas(ant_uvw, diameters, tolerance=0.0):
+    # (time, antenna) True where an antenna closer to the source overlaps it in projection, like flagdata
+    # the dishes overlap if their uv distance is <= the mean diameter less tolerance
+    du = ant_uvw[:, None, :, :] - ant_uvw[:, :, None, :]
+    uvdist = np.hypot(du[..., 0], du[..., 1])
+    limit = (diameters[:, None] + diameters[None, :]) / 2 - tolerance
+    # du[t, i, j] = uvw(j) - uvw(i), antenna i is behind j if j has the larger w
+    with np.errstate(invalid="ignore"):
+        blocked = (uvdist <= limit) & (du[..., 2] > 0)
+    return np.any(blocked, axis=2)
+
+
+def scan_starts(times, scans, fields, ddids):
+    # First TIME of the (scan, field, spw) each row belongs to, that being what flagdata quacks over
+    keys = (scans.astype(np.int64) * (fields.max() + 1) + fields) * (ddids.max() + 1) + ddids
+    ukeys, idx = np.unique(keys, return_inverse=True)
+    starts = np.full(len(ukeys), np.inf)
+    np.minimum.at(starts, idx, times)
+    return starts[idx]
+
+
+def online_flags(vis, shadow=True, tolerance=0.0, clipzeros=True, quackinterval=5.0, datacolumn="DATA"):
+    # Returns the fraction of the data flagged afterwards
+    t = table(vis, readonly=False, ack=False)
+    ant = table(f"{vis}/ANTENNA", ack=False)
+    diameters = ant.getcol("DISH_DIAMETER")
+    ant.close()
+
+    # Whole rows to flag, from the metadata alone
+    times = t.getcol("TIME")
+    ant1 = t.getcol("ANTENNA1")
+    ant2 = t.getcol("ANTENNA2")
+    row_flag = np.zeros(t.nrows(), dtype=bool)
+    cross = ant1 != ant2
+    if shadow and cross.any():
+        uvw = t.getcol("UVW")
+        utimes, ant_uvw = antenna_uvw(times[cross], ant1[cross], ant2[cross], uvw[cross], len(diameters))
+        shadowed = shadowed_antennas(ant_uvw, diameters, tolerance)
+        itime = np.searchsorted(utimes, times).clip(0, max(len(utimes) - 1, 0))
+        row_flag |= shadowed[itime, ant1] | shadowed[itime, ant2]
+        print(f"Shadowed: {row_flag.sum()} of {t.nrows()} rows")
+    if quackinterval > 0:
+        starts = scan_starts(times, t.getcol("SCAN_NUMBER"), t.getcol("FIELD_ID"), t.getcol("DATA_DESC_ID"))
+        quacked = times <= starts + quackinterval
+        print(f"Quacked: {quacked.sum()} of {t.nrows()} rows")
+        row_flag |= quacked
+
+    # flagdata sets FLAG_ROW for the row based modes, not for clipping
+    t.putcol("FLAG_ROW", t.getcol("FLAG_ROW") | row_flag)
+    flagged = 0
+    total = 0
+    for ddids in msio.shape_groups(vis):
+        sub = msio.select_rows(t, vis, ddids=ddids)
+        rownrs = np.arange(t.nrows()) if ddids is None else sub.rownumbers(t)
+        for start in range(0, sub.nrows(), msio.chunk_rows):
+            nrow = min(msio.chunk_rows, sub.nrows() - start)
+            flag = sub.getcol("FLAG", start, nrow)
+            new_flag = flag | row_flag[rownrs[start:start + nrow], None, None]
+            if clipzeros:
+                data = sub.getcol(datacolumn, start, nrow)
+                new_flag |= (data == 0) | ~np.isfinite(data)
+            if np.any(new_flag != flag):
+                sub.putcol("FLAG", new_flag, start, nrow)
+            flagged += new_flag.sum()
+            total += new_flag.size
+    t.close()
+    return flagged / max(total, 1)
+
+
+def weighted_median(values, weights):
+    # Elementwise median over axis 0 of values, each entry counting weights times (nan entries are ignored)
+    weights = np.where(np.isnan(values), 0, weights)
+    order = np.argsort(np.where(np.isnan(values), np.inf, values), axis=0)
+    values = np.take_along_axis(values, order, axis=0)
+    cum = np.cumsum(np.take_along_axis(weights, order, axis=0), axis=0)
+    half = np.argmax(cum >= cum[-1:] / 2, axis=0)
+    median = np.take_along_axis(values, half[None], axis=0)[0]
+    return np.where(cum[-1] > 0, median, np.nan)
+
+
+def window_rms(cube, winsize):
+    # RMS over a sliding window of winsize timesteps along axis 1, ignoring nans (needs 2 points, else nan)
+    valid = ~np.isnan(cube)
+    half = winsize // 2
+    pad = [(0, 0), (half + 1, half)] + [(0, 0)] * (cube.ndim - 2)
+    sums = [np.cumsum(np.pad(arr, pad), axis=1) for arr in [np.where(valid, cube, 0), np.where(valid, cube, 0) ** 2]]
+    count = np.cumsum(np.pad(valid, pad), axis=1)
+    window = [arr[:, winsize:] - arr[:, :-winsize] for arr in sums + [count]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = window[0] / window[2]
+        rms = np.sqrt(np.maximum(window[1] / window[2] - mean ** 2, 0))
+    return np.where(window[2] >= 2, rms, np.nan)
+
+
+def rflag_cube(amp, winsize):
+    # Amplitudes arranged (baseline, time, channel, correlation) to the two RFlag statistics: the rms over a sliding
+    # window in time, and the deviation from the median over the spw at each time
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        freq_dev = np.abs(amp - np.nanmedian(amp, axis=2, keepdims=True))
+    return window_rms(amp, winsize), freq_dev
+
+
+def rflag_groups(cols, datacolumn):
+    # Splits a chunk into (field, ddid) groups, each as an amplitude cube (flagged data as nan) and the rows/cells
+    # of the cube that each row of the chunk fills
+    for key in np.unique(np.stack([cols["FIELD_ID"], cols["DATA_DESC_ID"]], axis=1), axis=0):
+        rows = np.flatnonzero((cols["FIELD_ID"] == key[0]) & (cols["DATA_DESC_ID"] == key[1]))
+        utimes, itime = np.unique(cols["TIME"][rows], return_inverse=True)
+        ubls, ibl = np.unique(cols["ANTENNA1"][rows] * 10000 + cols["ANTENNA2"][rows], return_inverse=True)
+        data = cols[datacolumn][rows]
+        amp = np.full((len(ubls), len(utimes)) + data.shape[1:], np.nan)
+        amp[ibl, itime] = np.where(cols["FLAG"][rows], np.nan, np.abs(data))
+        yield (int(key[0]), int(key[1])), rows, ibl, itime, amp
+
+
+def rflag_chunks(t, vis, fields, datacolumn, max_memory, winsize):
+    # Row chunks sized to stay under max_memory bytes, each ending at a change of TIME so a timestep isn't split
+    columns = [datacolumn, "FLAG", "TIME", "ANTENNA1", "ANTENNA2", "FIELD_ID", "DATA_DESC_ID"]
+    for ddids in msio.shape_groups(vis):
+        sub = msio.select_rows(t, vis, field=fields, ddids=ddids)
+        if sub.nrows() == 0:
+            continue
+        cell = np.prod(sub.getcol("FLAG", 0, 1).shape[1:])
+        # data, flag and the working copies (amplitude cube, its window sums, the two statistics)
+        nrows = max(int(max_memory // (cell * (8 + 1 + 8 * (winsize + 6)))), 1)
+        times = sub.getcol("TIME")
+        start = 0
+        while start < sub.nrows():
+            end = min(start + nrows, sub.nrows())
+            while end < sub.nrows() and times[end] == times[end - 1]:
+                end += 1
+            yield sub, start, end - start, {col: sub.getcol(col, start, end - start) for col in columns}
+            start = end
+
+
+def rflag(vis, fields, datacolumn="CORRECTED_DATA", timedevscale=3.0, freqdevscale=3.0, winsize=3, max_memory=2e9):
+    # RFlag style flagging of every field in fields in the same two sweeps of the ms, each chunk held to max_memory.
+    # Sweep 1 gathers the noise levels per field and spw: the median windowed time rms per channel/correlation and
+    # the median deviation from the spectral median per correlation. Sweep 2 flags points where either is exceeded
+    # timedevscale/freqdevscale times over, like flagdata mode="rflag" with correlation="ABS_ALL" and
+    # combinescans=True, but without holding a whole field in memory. Time windows stop at chunk edges.
+    t = table(vis, readonly=False, ack=False)
+    field_ids = msio.field_ids(vis, ",".join(fields))
+    time_stats = {}
+    freq_stats = {}
+    for sub, start, nrow, cols in rflag_chunks(t, vis, field_ids, datacolumn, max_memory, winsize):
+        for key, rows, ibl, itime, amp in rflag_groups(cols, datacolumn):
+            time_rms, freq_dev = rflag_cube(amp, winsize)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                time_stats.setdefault(key, []).append(
+                    (np.nanmedian(time_rms, axis=(0, 1)), np.sum(~np.isnan(time_rms), axis=(0, 1)))
+                )
+                freq_stats.setdefault(key, []).append(
+                    (np.nanmedian(freq_dev, axis=(0, 1, 2)), np.sum(~np.isnan(freq_dev), axis=(0, 1, 2)))
+                )
+    time_dev = {key: weighted_median(*map(np.array, zip(*stats))) for key, stats in time_stats.items()}
+    freq_dev = {key: weighted_median(*map(np.array, zip(*stats))) for key, stats in freq_stats.items()}
+
+    flagged = {}
+    for sub, start, nrow, cols in rflag_chunks(t, vis, field_ids, datacolumn, max_memory, winsize):
+        flag = cols["FLAG"]
+        for key, rows, ibl, itime, amp in rflag_groups(cols, datacolumn):
+            time_rms, dev = rflag_cube(amp, winsize)
+            with np.errstate(invalid="ignore"):
+                bad = (time_rms > timedevscale * time_dev[key]) | (dev > freqdevscale * freq_dev[key])
+            new = bad[ibl, itime] & ~flag[rows]
+            flag[rows] |= new
+            counts = flagged.setdefault(key[0], [0, 0])
+            counts[0] += new.sum()
+            counts[1] += new.size
+        sub.putcol("FLAG", flag, start, nrow)
+    t.close()
+    fld = table(f"{vis}/FIELD", ack=False)
+    names = fld.getcol("NAME")
+    fld.close()
+    # Fraction of each field's data newly flagged
+    return {names[field_id]: new / max(size, 1) for field_id, (new, size) in flagged.items()}
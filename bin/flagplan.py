@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# Flag plans: the flagdata commands a process.py step would issue one after another are collected first, then
+# consecutive commands on the same ms and data column that don't need each other's flags are run together, as one
+# flagdata(mode="list") call or, with engine="numpy", one pass of the flagging.py equivalent (rflag, or
+# shadow/clip/quack). Each step reports how many passes over the ms its groups took, where separate flagdata calls
+# would take one per command, and the time a pass took.
+
+import time
+from casatasks import flagdata
+import tracing
+import flagging
+
+flagdata = tracing.traced(flagdata)
+rflag = tracing.traced(flagging.rflag)
+online_flags = tracing.traced(flagging.online_flags)
+
+# Task level flagdata parameters, which mode="list" takes once for the whole list rather than per command
+task_params = ["datacolumn", "action", "display", "flagbackup"]
+# Modes that don't look at the visibilities, so they can share a group reading any data column
+metadata_modes = ["manual", "shadow", "quack", "elevation", "extend", "summary"]
+# Modes whose result depends on what's already flagged. Within a flagdata list every command sees the flags as they
+# were before the list, so these can only join a group that flags other fields.
+flag_dependent_modes = ["rflag", "tfcrop", "extend", "antint"]
+datacolumns = {"data": "DATA", "corrected": "CORRECTED_DATA", "model": "MODEL_DATA"}
+# Settings of mode="rflag" that flagging.rflag reproduces, anything else set has to go to flagdata
+rflag_native = {
+    "correlation": ["ABS_ALL"],
+    "combinescans": [True],
+    "ntime": ["9999999min"],
+    "extendflags": [False],
+}
+
+
+def new_plan(stage):
+    # stage: name of the process.py step the commands are for, used for the trace records and the report
+    return {"stage": stage, "commands": []}
+
+
+def add(plan, vis, **params):
+    # params as they'd be passed to flagdata
+    plan["commands"].append(dict(params, vis=vis))
+    return
+
+
+def command_datacolumn(cmd):
+    if cmd["mode"] in metadata_modes:
+        return None
+    return cmd.get("datacolumn", "data")
+
+
+def independent(cmd, group):
+    # Whether cmd gives the same flags run alongside the group's commands as after them
+    if cmd["mode"] not in flag_dependent_modes:
+        return True
+    fields = set(str(cmd.get("field", "")).split(","))
+    for other in group["commands"]:
+        other_fields = set(str(other.get("field", "")).split(","))
+        if "" in fields or "" in other_fields or fields & other_fields:
+            return False
+    return True
+
+
+def native_kind(cmd):
+    # Which flagging.py pass can do cmd, if any
+    if cmd["mode"] == "rflag":
+        settings = {key: val for key, val in cmd.items() if key not in task_params + ["vis", "mode", "field"]}
+        for key, val in settings.items():
+            if key in rflag_native and val not in rflag_native[key]:
+                return None
+            if key not in rflag_native and key not in ["timedevscale", "freqdevscale", "winsize"]:
+                return None
+        return "rflag"
+    # The online flags are worked out for the whole ms, so only commands without a selection
+    allowed = {"shadow": ["tolerance"], "clip": ["clipzeros"], "quack": ["quackinterval", "quackmode"]}
+    if cmd["mode"] in allowed:
+        extra = set(cmd) - set(task_params + ["vis", "mode"] + allowed[cmd["mode"]])
+        if extra or cmd.get("quackmode", "beg") != "beg" or (cmd["mode"] == "clip" and not cmd.get("clipzeros")):
+            return None
+        return "online"
+    return None
+
+
+def rflag_settings(cmd):
+    # flagdata's defaults for anything not given
+    defaults = {"timedevscale": 5.0, "freqdevscale": 5.0, "winsize": 3}
+    return {key: cmd.get(key, default) for key, default in defaults.items()}
+
+
+def compile_plan(plan, engine="casa"):
+    # Consecutive commands on the same ms whose data columns agree go in one group, so the order commands were
+    # added in is kept, unless a command needs the flags the group makes. With engine="numpy" commands flagging.py
+    # can do are grouped apart from the rest.
+    groups = []
+    for cmd in plan["commands"]:
+        kind = native_kind(cmd) if engine == "numpy" else None
+        column = command_datacolumn(cmd)
+        group = groups[-1] if groups else None
+        joins = (
+            group is not None
+            and group["vis"] == cmd["vis"]
+            and group["kind"] == kind
+            and (column is None or group["datacolumn"] in [None, column])
+            and (kind != "rflag" or rflag_settings(group["commands"][0]) == rflag_settings(cmd))
+            and independent(cmd, group)
+        )
+        if not joins:
+            group = {"vis": cmd["vis"], "kind": kind, "datacolumn": None, "commands": []}
+            groups.append(group)
+        group["datacolumn"] = group["datacolumn"] or column
+        group["commands"].append(cmd)
+    return groups
+
+
+def command_line(cmd):
+    # One line of a flagdata list, e.g. mode='rflag' field='1934-638' timedevscale=3.0
+    return " ".join(f"{key}={val!r}" for key, val in cmd.items() if key not in task_params + ["vis"])
+
+
+def run_group(group):
+    cmds = group["commands"]
+    if group["kind"] == "rflag":
+        # A command without a field flags them all
+        fields = [cmd.get("field", "") for cmd in cmds]
+        fields = [""] if "" in fields else ",".join(fields).split(",")
+        column = datacolumns[group["datacolumn"] or "data"]
+        fractions = rflag(group["vis"], fields, datacolumn=column, **rflag_settings(cmds[0]))
+        for fld, frac in fractions.items():
+            print(f"rflag newly flagged {100 * frac:.2f}% of {fld}")
+    elif group["kind"] == "online":
+        modes = {cmd["mode"]: cmd for cmd in cmds}
+        online_flags(
+            group["vis"],
+            shadow="shadow" in modes,
+            tolerance=modes.get("shadow", {}).get("tolerance", 0.0),
+            clipzeros="clip" in modes,
+            quackinterval=modes.get("quack", {}).get("quackinterval", 1.0) if "quack" in modes else 0.0,
+        )
+    else:
+        flagdata(
+            vis=group["vis"],
+            mode="list",
+            inpfile=[command_line(cmd) for cmd in cmds],
+            datacolumn=group["datacolumn"] or "data",
+            action="apply",
+            display="",
+            flagbackup=False,
+        )
+    return
+
+
+def run(plan, engine="casa"):
+    # Runs the plan and returns its groups, each with the wall time it took
+    groups = compile_plan(plan, engine)
+    with tracing.stage(plan["stage"]):
+        for group in groups:
+            start = time.time()
+            run_group(group)
+            group["wall_time"] = time.time() - start
+    if not groups:
+        return groups
+    # Every flagdata call goes through the ms once, whatever its mode, so run separately each command is a pass
+    wall_time = sum(group["wall_time"] for group in groups)
+    print(
+        f"{plan['stage']}: {len(plan['commands'])} flag commands in {len(groups)} passes over the ms instead of "
+        f"{len(plan['commands'])}, took {wall_time:.1f}s ({wall_time / len(groups):.1f}s a pass)"
+    )
+    return groups
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# Saved flag versions kept next to the ms in {vis}.flagstore, in place of flagmanager(mode="save") copying the whole
+# FLAG column into {vis}.flagversions every time. FLAG is bit packed (one bit per flag) and most versions are stored
+# as the XOR against the version saved before them, which is nearly all zeros and compresses to almost nothing.
+# Every keyframe_every versions a full snapshot is kept so a restore never has to unpick a long chain.
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from casacore.tables import table
+import msio
+
+keyframe_every = 8
+
+
+def store_dir(vis):
+    return f"{vis}.flagstore"
+
+
+def read_index(vis):
+    # Saved versions in the order they were saved
+    index_file = f"{store_dir(vis)}/versions.json"
+    if not os.path.exists(index_file):
+        return []
+    with open(index_file) as index:
+        return json.load(index)
+
+
+def write_index(vis, versions):
+    index_file = f"{store_dir(vis)}/versions.json"
+    with open(f"{index_file}.tmp", "w") as index:
+        json.dump(versions, index, indent=1)
+    os.replace(f"{index_file}.tmp", index_file)
+    return
+
+
+def row_digest(sub):
+    # Fingerprint of the order of the rows, so flags are never put back onto rows that have been reordered (as
+    # partitioning does) even when their number and shape still match
+    digest = hashlib.sha1()
+    for start in range(0, sub.nrows(), msio.chunk_rows):
+        nrow = min(msio.chunk_rows, sub.nrows() - start)
+        for col in ["TIME", "ANTENNA1", "ANTENNA2"]:
+            digest.update(np.ascontiguousarray(sub.getcol(col, start, nrow)).tobytes())
+    return digest.hexdigest()
+
+
+def read_packed(vis):
+    # FLAG and FLAG_ROW of every shape group of rows, packed to a bit per flag. FLAG is packed a row at a time so
+    # the chunks line up, giving (nrow, ceil(nchan * ncorr / 8)) bytes per group.
+    t = table(vis, ack=False)
+    groups = []
+    for ddids in msio.shape_groups(vis):
+        sub = msio.select_rows(t, vis, ddids=ddids)
+        flag = []
+        flag_row = []
+        for start in range(0, sub.nrows(), msio.chunk_rows):
+            nrow = min(msio.chunk_rows, sub.nrows() - start)
+            chunk = sub.getcol("FLAG", start, nrow)
+            flag.append(np.packbits(chunk.reshape(nrow, -1), axis=1))
+            flag_row.append(sub.getcol("FLAG_ROW", start, nrow))
+        groups.append(
+            {
+                "cell": list(chunk.shape[1:]) if flag else [0, 0],
+                "flag": np.concatenate(flag) if flag else np.zeros((0, 0), np.uint8),
+                "flag_row": np.packbits(np.concatenate(flag_row)) if flag_row else np.zeros(0, np.uint8),
+                "nrows": sub.nrows(),
+                "rows": row_digest(sub),
+            }
+        )
+    t.close()
+    return groups
+
+
+def layout(groups):
+    return [[group["nrows"]] + group["cell"] + [group["rows"]] for group in groups]
+
+
+def load_packed(vis, versions, name):
+    # Packed flags of a saved version, following its chain of deltas back to a full snapshot
+    entry = next(ver for ver in versions if ver["name"] == name)
+    with np.load(f"{store_dir(vis)}/{entry['file']}") as stored:
+        arrays = {key: stored[key] for key in stored.files}
+    if entry["base"] is not None:
+        base = load_packed(vis, versions, entry["base"])
+        arrays = {key: arrays[key] ^ base[key] for key in arrays}
+    return arrays
+
+
+def chain_length(versions, name):
+    entry = next(ver for ver in versions if ver["name"] == name)
+    return 0 if entry["base"] is None else 1 + chain_length(versions, entry["base"])
+
+
+def write_version(vis, versions, name, arrays, base, shapes, comment=""):
+    # Stores arrays (packed flags) as a delta on base, or in full if base is None
+    if base is not None:
+        base_arrays = load_packed(vis, versions, base)
+        arrays = {key: arrays[key] ^ base_arrays[key] for key in arrays}
+    filename = f"{len(os.listdir(store_dir(vis)))}_{time.time_ns()}.npz"
+    with open(f"{store_dir(vis)}/{filename}.tmp", "wb") as version_file:
+        np.savez_compressed(version_file, **arrays)
+    os.replace(f"{store_dir(vis)}/{filename}.tmp", f"{store_dir(vis)}/{filename}")
+    return {"name": name, "file": filename, "base": base, "layout": shapes, "comment": comment, "saved": time.time()}
+
+
+def save(vis, versionname, comment="", delta=True):
+    # Like flagmanager(vis=vis, mode="save", versionname=versionname), a version saved again is replaced
+    os.makedirs(store_dir(vis), exist_ok=True)
+    if versionname in [ver["name"] for ver in read_index(vis)]:
+        delete(vis, versionname)
+    versions = read_index(vis)
+    groups = read_packed(vis)
+    arrays = {}
+    for i, group in enumerate(groups):
+        arrays[f"flag_{i}"] = group["flag"]
+        arrays[f"flag_row_{i}"] = group["flag_row"]
+    # Deltas only make sense against a version of the same rows
+    base = None
+    if delta and versions and versions[-1]["layout"] == layout(groups):
+        if chain_length(versions, versions[-1]["name"]) + 1 < keyframe_every:
+            base = versions[-1]["name"]
+    versions.append(write_version(vis, versions, versionname, arrays, base, layout(groups), comment))
+    write_index(vis, versions)
+    print(f"Saved flag version {versionname} of {vis}" + (f" as changes since {base}" if base else ""))
+    return
+
+
+def restore(vis, versionname):
+    # Like flagmanager(vis=vis, mode="restore", versionname=versionname), FLAG and FLAG_ROW are put back as saved
+    versions = read_index(vis)
+    if versionname not in [ver["name"] for ver in versions]:
+        raise ValueError(f"No flag version {versionname} saved for {vis}")
+    entry = next(ver for ver in versions if ver["name"] == versionname)
+    arrays = load_packed(vis, versions, versionname)
+    t = table(vis, readonly=False, ack=False)
+    groups = msio.shape_groups(vis)
+    if len(groups) != len(entry["layout"]):
+        raise ValueError(f"Flag version {versionname} was saved from a different layout of {vis}")
+    for i, ddids in enumerate(groups):
+        sub = msio.select_rows(t, vis, ddids=ddids)
+        nrows, nchan, ncorr, rows = entry["layout"][i]
+        if sub.nrows() != nrows or rows != row_digest(sub):
+            raise ValueError(f"Flag version {versionname} was saved from a different layout of {vis}")
+        flag_row = np.unpackbits(arrays[f"flag_row_{i}"], count=nrows).astype(bool)
+        for start in range(0, nrows, msio.chunk_rows):
+            nrow = min(msio.chunk_rows, nrows - start)
+            packed = arrays[f"flag_{i}"][start : start + nrow]
+            flag = np.unpackbits(packed, axis=1, count=nchan * ncorr).astype(bool).reshape(nrow, nchan, ncorr)
+            sub.putcol("FLAG", flag, start, nrow)
+            sub.putcol("FLAG_ROW", flag_row[start : start + nrow], start, nrow)
+    t.close()
+    print(f"Restored flag version {versionname} of {vis}")
+    return
+
+
+def delete(vis, versionname):
+    # Versions stored as changes on the deleted one are rewritten against its own base first
+    versions = read_index(vis)
+    entry = next(ver for ver in versions if ver["name"] == versionname)
+    for i, ver in enumerate(versions):
+        if ver["base"] == versionname:
+            arrays = load_packed(vis, versions, ver["name"])
+            rebased = write_version(vis, versions, ver["name"], arrays, entry["base"], ver["layout"], ver["comment"])
+            versions[i] = dict(rebased, saved=ver["saved"])
+            os.remove(f"{store_dir(vis)}/{ver['file']}")
+    versions = [ver for ver in versions if ver["name"] != versionname]
+    write_index(vis, versions)
+    os.remove(f"{store_dir(vis)}/{entry['file']}")
+    return
+
+
+def list_versions(vis):
+    return [ver["name"] for ver in read_index(vis)]
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# Reads an image plane, or just a window of one, for plotting and export. A handle to each image (with its shape and
+# WCS) is kept open between reads, so plotting every spw and round of a target opens each image once and only reads
+# the pixels that end up on the plot. An image rewritten since it was opened is opened again.
+# write_fits stands in for exportfits: the planes are streamed into a memory mapped FITS file one at a time, and the
+# plot and the quick look previews (block averages no bigger than preview_sizes) are made from that file rather
+# than from a second read of the image.
+
+import os
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+from astropy import units as u
+from astropy.wcs import WCS
+from astropy.visualization import simple_norm
+from matplotlib import image as mpimg
+from casatools import image as IA
+import pipeline
+
+rad_to_deg = 180 / np.pi
+fits_stokes = {"I": 1, "Q": 2, "U": 3, "V": 4, "RR": -1, "LL": -2, "RL": -3, "LR": -4}
+fits_stokes.update({"XX": -5, "YY": -6, "XY": -7, "YX": -8})
+radesys = {"J2000": ("FK5", 2000.0), "B1950": ("FK4", 1950.0), "ICRS": ("ICRS", None)}
+# Largest side of each preview level, largest first
+preview_sizes = [1024, 512, 256]
+# Open images by absolute path
+handles = {}
+
+
+def open_image(imname):
+    path = os.path.abspath(imname)
+    mtime = pipeline.newest_mtime(path)
+    if path in handles and handles[path]["mtime"] == mtime:
+        return handles[path]
+    close(path)
+    tool = IA()
+    tool.open(path)
+    csys = tool.coordsys()
+    w = WCS(naxis=2)
+    # CASA reference pixels count from 0, FITS ones from 1
+    w.wcs.crpix = csys.referencepixel()["numeric"][0:2] + 1
+    w.wcs.cdelt = csys.increment()["numeric"][0:2] * rad_to_deg
+    w.wcs.crval = csys.referencevalue()["numeric"][0:2] * rad_to_deg
+    w.wcs.ctype = ["RA---SIN", "DEC--SIN"]
+    csys.done()
+    handles[path] = {"tool": tool, "shape": [int(n) for n in tool.shape()], "wcs": w, "mtime": mtime}
+    return handles[path]
+
+
+def close(imname):
+    handle = handles.pop(os.path.abspath(imname), None)
+    if handle is not None:
+        handle["tool"].close()
+    return
+
+
+def close_all():
+    for path in list(handles):
+        close(path)
+    return
+
+
+def central_window(imname, lo=0.25, hi=0.75):
+    # (blc, trc) of the middle of the image, from lo to hi of the way across on both axes
+    nx = open_image(imname)["shape"][0]
+    return [int(nx * lo)] * 2, [int(nx * hi) - 1] * 2
+
+
+def read_region(imname, blc=None, trc=None, chan=0, stokes=0):
+    # Pixels of plane (stokes, chan) of imname between pixel corners blc and trc ([x, y], both included), the whole
+    # plane if they aren't given, indexed [x, y] like ia.getchunk. Returns them with the WCS of the window.
+    handle = open_image(imname)
+    shape = handle["shape"]
+    blc = [0, 0] if blc is None else [int(p) for p in blc]
+    trc = [shape[0] - 1, shape[1] - 1] if trc is None else [int(p) for p in trc]
+    plane = [stokes, chan][: len(shape) - 2]
+    chunk = handle["tool"].getchunk(blc=blc + plane, trc=trc + plane)
+    pix = chunk.reshape(trc[0] - blc[0] + 1, trc[1] - blc[1] + 1)
+    return pix, window_wcs(handle["wcs"], blc)
+
+
+def window_wcs(w, blc):
+    # WCS of the window of an image starting at pixel blc
+    w = w.deepcopy()
+    w.wcs.crpix = w.wcs.crpix - blc
+    return w
+
+
+def cut_window(pix, w, blc, trc):
+    # The blc to trc window (both included) of a plane already in memory, like read_region gives it
+    return pix[blc[0] : trc[0] + 1, blc[1] : trc[1] + 1], window_wcs(w, blc)
+
+
+def plane_axes(handle):
+    # Positions of the stokes and spectral axes in the image, after the two direction axes
+    types = list(handle["tool"].coordsys().axiscoordinatetypes())
+    return types.index("Stokes"), types.index("Spectral")
+
+
+def fits_header(handle):
+    # FITS header for the image laid out as exportfits does it: RA, Dec, frequency, stokes
+    tool = handle["tool"]
+    csys = tool.coordsys()
+    stokes_axis, spectral_axis = plane_axes(handle)
+    refpix = csys.referencepixel()["numeric"]
+    inc = csys.increment()["numeric"]
+    refval = csys.referencevalue()["numeric"]
+    shape = handle["shape"]
+    header = fits.PrimaryHDU(data=np.zeros((1, 1, 1, 1), dtype=np.float32)).header
+    for i, n in enumerate([shape[0], shape[1], shape[spectral_axis], shape[stokes_axis]]):
+        header[f"NAXIS{i + 1}"] = n
+    beam = tool.restoringbeam()
+    if "major" in beam:
+        for key, name in [("BMAJ", "major"), ("BMIN", "minor"), ("BPA", "positionangle")]:
+            header[key] = u.Quantity(beam[name]["value"], beam[name]["unit"]).to_value(u.deg)
+    header["BTYPE"] = "Intensity"
+    header["BUNIT"] = tool.brightnessunit()
+    frame, equinox = radesys.get(csys.referencecode("direction")[0], ("FK5", 2000.0))
+    header["RADESYS"] = frame
+    if equinox is not None:
+        header["EQUINOX"] = equinox
+    projection = csys.projection()["type"]
+    for i, ctype in enumerate([f"RA---{projection}", f"DEC--{projection}"]):
+        header[f"CTYPE{i + 1}"] = ctype
+        header[f"CRVAL{i + 1}"] = refval[i] * rad_to_deg
+        header[f"CDELT{i + 1}"] = inc[i] * rad_to_deg
+        header[f"CRPIX{i + 1}"] = refpix[i] + 1
+        header[f"CUNIT{i + 1}"] = "deg"
+    header["CTYPE3"] = "FREQ"
+    header["CRVAL3"] = refval[spectral_axis]
+    header["CDELT3"] = inc[spectral_axis]
+    header["CRPIX3"] = refpix[spectral_axis] + 1
+    header["CUNIT3"] = "Hz"
+    stokes = [fits_stokes[name] for name in csys.stokes()]
+    header["CTYPE4"] = "STOKES"
+    header["CRVAL4"] = stokes[0]
+    header["CDELT4"] = stokes[1] - stokes[0] if len(stokes) > 1 else 1.0
+    header["CRPIX4"] = 1.0
+    header["RESTFRQ"] = float(csys.restfrequency()["value"][0])
+    header["SPECSYS"] = csys.referencecode("spectral")[0]
+    header["TELESCOP"] = csys.telescope()
+    header["OBSERVER"] = csys.observer()
+    header["DATE-OBS"] = Time(csys.epoch()["m0"]["value"], format="mjd", scale="utc").isot
+    header["TIMESYS"] = "UTC"
+    header["ORIGIN"] = "imgio.write_fits"
+    csys.done()
+    return header
+
+
+def write_fits(imname, fitsname):
+    # Writes imname to fitsname a plane at a time, masked pixels as NaN like exportfits. Returns the first plane
+    # (indexed [x, y] as read_region gives it) read back from the written file, and its WCS.
+    handle = open_image(imname)
+    tool = handle["tool"]
+    shape = handle["shape"]
+    stokes_axis, spectral_axis = plane_axes(handle)
+    header = fits_header(handle)
+    # Header plus the data padded to whole FITS blocks, filled in through a memory map
+    nbytes = shape[0] * shape[1] * shape[stokes_axis] * shape[spectral_axis] * 4
+    tmp_name = f"{fitsname}.tmp"
+    header.tofile(tmp_name, overwrite=True)
+    with open(tmp_name, "rb+") as fits_file:
+        fits_file.seek(len(header.tostring()) + -(-nbytes // 2880) * 2880 - 1)
+        fits_file.write(b"\0")
+    with fits.open(tmp_name, mode="update", memmap=True) as hdul:
+        data = hdul[0].data
+        for stokes in range(shape[stokes_axis]):
+            for chan in range(shape[spectral_axis]):
+                plane_blc = [0] * len(shape)
+                plane_blc[stokes_axis] = stokes
+                plane_blc[spectral_axis] = chan
+                plane_trc = [shape[0] - 1, shape[1] - 1] + plane_blc[2:]
+                pix = tool.getchunk(blc=plane_blc, trc=plane_trc).reshape(shape[0], shape[1])
+                mask = tool.getchunk(blc=plane_blc, trc=plane_trc, getmask=True).reshape(shape[0], shape[1])
+                data[stokes, chan] = np.where(mask, pix, np.nan).transpose()
+        plane = np.array(data[0, 0]).transpose()
+    os.replace(tmp_name, fitsname)
+    return plane, handle["wcs"]
+
+
+def block_sum(pix, factor):
+    # Sums over factor x factor blocks, the last row and column of blocks padded out with zeros
+    pad = [(0, -n % factor) for n in pix.shape]
+    pix = np.pad(pix, pad)
+    return pix.reshape(pix.shape[0] // factor, factor, pix.shape[1] // factor, factor).sum(axis=(1, 3))
+
+
+def preview_levels(pix, sizes=preview_sizes):
+    # Block averages of pix, the first no bigger than sizes[0] on a side and each after that made from 2x2 blocks
+    # of the one before until it's no bigger than its size, so the full plane is only gone through once.
+    # NaNs are left out of the averages, a block of nothing but NaNs stays NaN.
+    finite = np.isfinite(pix)
+    factor = -(-max(pix.shape) // sizes[0])
+    sums = block_sum(np.where(finite, pix, 0.0), factor)
+    counts = block_sum(finite.astype(np.int64), factor)
+    levels = []
+    for size in sizes:
+        while max(sums.shape) > size:
+            sums = block_sum(sums, 2)
+            counts = block_sum(counts, 2)
+        levels.append(np.divide(sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0))
+    return levels
+
+
+def write_previews(pix, prefix, stretch="sqrt", sizes=preview_sizes):
+    # PNGs {prefix}_preview{size}.png of each preview level of pix ([x, y]), all on the stretch of the largest.
+    # Returns what was written for the preview index.
+    levels = preview_levels(pix, sizes)
+    norm = simple_norm(levels[0][np.isfinite(levels[0])], stretch)
+    previews = []
+    for size, level in zip(sizes, levels):
+        png = f"{prefix}_preview{size}.png"
+        scaled = np.ma.filled(np.ma.masked_invalid(norm(level.transpose())), np.nan)
+        mpimg.imsave(png, scaled, origin="lower", cmap="plasma", vmin=0.0, vmax=1.0)
+        previews.append({"size": size, "png": png, "shape": list(level.shape)})
+    return previews
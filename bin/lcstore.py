@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# One file per target/band/epoch holding every fitted lightcurve bin (start, flux, error and fit details) as columns,
+# in place of a component list per bin. New bins are merged in as they're fit, so a rerun only fits the bins it's
+# missing. The store remembers the ms and fit settings it came from and is thrown away if those change.
+
+import os
+import json
+import numpy as np
+from casacore.tables import table
+import pipeline
+
+columns = [
+    "start",
+    "interval",
+    "flux",
+    "flux_err",
+    "offset_x",
+    "offset_y",
+    "offset_err_x",
+    "offset_err_y",
+    "chi2_red",
+    "nsamples",
+]
+# Bin starts closer than this (seconds) are the same bin
+start_tol = 1e-3
+
+
+def store_path(outfile_dir):
+    # outfile_dir is the old per-bin .cl prefix, e.g. {src_dir}/casa_files/{target}_X_epoch5
+    return f"{outfile_dir}_lightcurve.npz"
+
+
+def fit_meta(vis, **settings):
+    # What the stored fluxes depend on: the ms as it is now plus whatever settings the fit was run with
+    tbl = table(vis, ack=False)
+    nrows = tbl.nrows()
+    tbl.close()
+    return dict(settings, vis=os.path.abspath(vis), nrows=nrows, mtime=pipeline.newest_mtime(vis))
+
+
+def empty_store():
+    return {col: np.zeros(0) for col in columns}
+
+
+def load(path, meta=None):
+    # Every column in one read, or an empty store if there's none yet or it was made from something else
+    if not os.path.exists(path):
+        return empty_store()
+    with np.load(path) as stored:
+        if meta is not None and json.loads(str(stored["meta"])) != json.loads(json.dumps(meta, default=str)):
+            print(f"{path} was fit from a different ms or with different settings, starting again")
+            return empty_store()
+        return {col: stored[col] for col in columns}
+
+
+def from_fit(fit):
+    # Columns from uvfit.fit_lightcurve. Bins with no data are kept too (nan flux), so they aren't fit again.
+    offset = np.broadcast_to(fit["offset"], (len(fit["start"]), 2))
+    offset_err = np.broadcast_to(fit["offset_err"], (len(fit["start"]), 2))
+    cols = {
+        "start": fit["start"],
+        "interval": np.full(len(fit["start"]), float(fit["interval"])),
+        "flux": fit["flux"],
+        "flux_err": fit["flux_err"],
+        "offset_x": offset[:, 0],
+        "offset_y": offset[:, 1],
+        "offset_err_x": offset_err[:, 0],
+        "offset_err_y": offset_err[:, 1],
+        "chi2_red": fit["chi2_red"],
+        "nsamples": fit["nsamples"],
+    }
+    return {col: np.asarray(val, dtype=float) for col, val in cols.items()}
+
+
+def find(store, starts, interval):
+    # Row of the store holding each of the bins asked for, -1 where it hasn't been fit
+    # interval is either one length for every bin or one per bin
+    starts = np.asarray(starts, dtype=float)
+    rows = np.full(len(starts), -1)
+    if len(store["start"]) == 0:
+        return rows
+    order = np.argsort(store["start"])
+    nearest = np.clip(np.searchsorted(store["start"][order], starts), 1, len(order)) - 1
+    for shift in [0, 1]:
+        cand = order[np.clip(nearest + shift, 0, len(order) - 1)]
+        match = (np.abs(store["start"][cand] - starts) < start_tol) & (store["interval"][cand] == interval)
+        rows = np.where((rows < 0) & match, cand, rows)
+    return rows
+
+
+def append(path, store, new, meta):
+    # Merges newly fit bins into store (refits replace what was there) and writes the lot back in one go
+    keep = find(new, store["start"], store["interval"]) < 0
+    merged = {col: np.concatenate([store[col][keep], new[col]]) for col in columns}
+    order = np.argsort(merged["start"], kind="stable")
+    merged = {col: val[order] for col, val in merged.items()}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as tmp_file:
+        np.savez(tmp_file, meta=json.dumps(meta, default=str), **merged)
+    os.replace(tmp_path, path)
+    return merged
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# Completion ledger for the long stages in process.py (self cal rounds, per spw cleans, uvmodelfit calls)
+# Each finished unit of work is written to a per-target json file along with a fingerprint of its parameters,
+# so a rerun after a crash picks up at the first unit that is missing or was run with different parameters.
+# A stage clears its own entries once it finishes, so rerunning a completed stage starts it from scratch.
+
+import os
+import json
+import time
+import hashlib
+
+
+def ledger_path(src_dir, name):
+    return f"{src_dir}/ledger_{name}.json"
+
+
+def load_ledger(path):
+    try:
+        with open(path) as ledger_file:
+            return json.load(ledger_file)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        print(f"Ledger {path} is unreadable, starting it again")
+        return {}
+
+
+def write_ledger(path, ledger):
+    # Write then rename so a crash part way through never leaves a truncated ledger behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as ledger_file:
+        json.dump(ledger, ledger_file, indent=1)
+    os.replace(tmp_path, path)
+    return
+
+
+def fingerprint(params, upstream=()):
+    # upstream: ledger records this unit was built on, so redoing any of them invalidates this one too
+    upstream_times = [None if rec is None else rec["completed"] for rec in upstream]
+    blob = json.dumps({"params": params, "upstream": upstream_times}, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def is_done(path, unit, fp):
+    rec = load_ledger(path).get(unit)
+    return rec is not None and rec["fingerprint"] == fp
+
+
+def get_record(path, unit):
+    return load_ledger(path).get(unit)
+
+
+def mark_done(path, unit, fp, **extra):
+    ledger = load_ledger(path)
+    ledger[unit] = dict(extra, fingerprint=fp, completed=time.time())
+    write_ledger(path, ledger)
+    return ledger[unit]
+
+
+def clear_stage(path, stage):
+    # Units are named "{stage}/{unit}", drop everything belonging to a finished stage
+    ledger = load_ledger(path)
+    ledger = {unit: rec for unit, rec in ledger.items() if not unit.startswith(f"{stage}/")}
+    if ledger:
+        write_ledger(path, ledger)
+    elif os.path.exists(path):
+        os.remove(path)
+    return
@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+# Direct casacore access to measurement sets, for jobs where a CASA task would otherwise read the same ms
+# over and over (e.g. one mstransform per epoch). Everything here streams the main table in row chunks.
+
+import shutil
+import hashlib
+import numpy as np
+from casacore.tables import table
+import workspace
+
+# MS TIME is in MJD seconds
+mjd_epoch = np.datetime64("1858-11-17T00:00:00", "us")
+chunk_rows = 100000
+
+
+def mjds_to_datetime64(times):
+    return mjd_epoch + np.round(np.asarray(times) * 1e6).astype("timedelta64[us]")
+
+
+def datetime64_to_mjds(times):
+    return (np.asarray(times, dtype="datetime64[us]") - mjd_epoch) / np.timedelta64(1, "s")
+
+
+def clock_to_timedelta(clock):
+    # "10:05:30.5", "10:05" or "10" (hours) to a timedelta64
+    fields = [float(part) for part in clock.split(":")]
+    seconds = sum(val * 60 ** (2 - i) for i, val in enumerate(fields))
+    return np.timedelta64(int(round(seconds * 1e6)), "us")
+
+
+def parse_casa_time(text, day):
+    # "2020/01/05/10:00:00", "2020/01/05" or "10:00:00" (taken to be on day) to a datetime64
+    # Days past the end of the month roll over like CASA does, so 2020/02/30 is 2020/03/01
+    parts = text.strip().split("/")
+    clock = parts[-1] if len(parts) in [1, 4] else "0"
+    if len(parts) >= 3:
+        month = np.datetime64(f"{int(parts[0]):04d}-{int(parts[1]):02d}", "D")
+        day = month + np.timedelta64(int(parts[2]) - 1, "D")
+    return day.astype("datetime64[us]") + clock_to_timedelta(clock)
+
+
+def first_day(vis):
+    # Date CASA assumes for times given without one
+    t = table(vis, ack=False)
+    day = mjds_to_datetime64(t.getcol("TIME").min()).astype("datetime64[D]")
+    t.close()
+    return day
+
+
+def timerange_mjds(vis, timerange):
+    # CASA style timerange to (start, end) in MJD seconds, None if there's nothing to select on
+    # Handles "T0~T1", "T0+dT", ">T0" and "<T1", times without a date are on the first day of the ms
+    if timerange in ["", None]:
+        return None
+    day = first_day(vis)
+    timerange = timerange.strip()
+    if timerange.startswith(">"):
+        start, end = parse_casa_time(timerange[1:], day), None
+    elif timerange.startswith("<"):
+        start, end = None, parse_casa_time(timerange[1:], day)
+    elif "~" in timerange:
+        start, end = [parse_casa_time(part, day) for part in timerange.split("~")]
+    elif "+" in timerange:
+        text, duration = timerange.split("+")
+        start = parse_casa_time(text, day)
+        end = start + clock_to_timedelta(duration)
+    else:
+        raise ValueError(f"Can't read timerange {timerange}")
+    return (
+        -np.inf if start is None else float(datetime64_to_mjds(start)),
+        np.inf if end is None else float(datetime64_to_mjds(end)),
+    )
+
+
+def timerange_query(vis, timerange):
+    # TaQL condition for select_rows/iter_chunks extra=
+    limits = timerange_mjds(vis, timerange)
+    if limits is None:
+        return ""
+    conds = []
+    if np.isfinite(limits[0]):
+        conds.append(f"TIME >= {limits[0]!r}")
+    if np.isfinite(limits[1]):
+        conds.append(f"TIME <= {limits[1]!r}")
+    return " && ".join(conds)
+
+
+def casa_timerange(start, end):
+    # datetime64 limits to a CASA timerange string, widened to whole seconds
+    start = np.datetime64(start, "s")
+    end = np.datetime64(end, "s") + np.timedelta64(1, "s")
+    return "~".join(str(lim).replace("-", "/").replace("T", "/") for lim in [start, end])
+
+
+def field_ids(vis, field):
+    # CASA style field selection ("", "1", "J001513", "0,2") to a list of FIELD_IDs, None for all fields
+    if field in ["", None]:
+        return None
+    fld = table(f"{vis}/FIELD", ack=False)
+    names = list(fld.getcol("NAME"))
+    fld.close()
+    ids = []
+    for sel in str(field).split(","):
+        sel = sel.strip()
+        if sel in names:
+            ids.append(names.index(sel))
+        elif sel.isdigit():
+            ids.append(int(sel))
+        else:
+            raise ValueError(f"No field {sel} in {vis}")
+    return ids
+
+
+def shape_groups(vis):
+    # DATA_DESC_IDs that can be read together: getcol needs every row in a chunk to have the same data shape
+    dd = table(f"{vis}/DATA_DESCRIPTION", ack=False)
+    spw_ids = dd.getcol("SPECTRAL_WINDOW_ID")
+    pol_ids = dd.getcol("POLARIZATION_ID")
+    dd.close()
+    spw = table(f"{vis}/SPECTRAL_WINDOW", ack=False)
+    num_chan = spw.getcol("NUM_CHAN")
+    spw.close()
+    pol = table(f"{vis}/POLARIZATION", ack=False)
+    num_corr = pol.getcol("NUM_CORR")
+    pol.close()
+    shapes = [(num_chan[s], num_corr[p]) for s, p in zip(spw_ids, pol_ids)]
+    if len(set(shapes)) <= 1:
+        return [None]
+    return [[ddid for ddid, shp in enumerate(shapes) if shp == group] for group in sorted(set(shapes))]
+
+
+def select_rows(t, vis, field=None, ddids=None, extra=""):
+    # Reference table of the rows matching the selection, or the table itself if there's nothing to select
+    conds = []
+    if field is not None:
+        conds.append(f"FIELD_ID IN {list(field)}")
+    if ddids is not None:
+        conds.append(f"DATA_DESC_ID IN {list(ddids)}")
+    if extra:
+        conds.append(extra)
+    if not conds:
+        return t
+    return t.query(" && ".join(conds))
+
+
+def iter_chunks(t, vis, columns, field=None, extra="", nrows=chunk_rows):
+    # Yields (sub, start, nrow, {column: values}) for consecutive row chunks of the selected rows.
+    # sub is the (reference) table the chunk came from, so sub.putcol(col, values, start, nrow) writes back.
+    for ddids in shape_groups(vis):
+        sub = select_rows(t, vis, field=field, ddids=ddids, extra=extra)
+        for start in range(0, sub.nrows(), nrows):
+            nrow = min(nrows, sub.nrows() - start)
+            yield sub, start, nrow, {col: sub.getcol(col, start, nrow) for col in columns}
+
+
+def flag_weight_digests(vis):
+    # sha1 per spw of what the psf depends on besides the imaging parameters: FLAG, FLAG_ROW and the weights.
+    # Weights count to 5 significant figures, so the rounding of a phase only applycal (calwt) isn't a change.
+    dd = table(f"{vis}/DATA_DESCRIPTION", ack=False)
+    spw_ids = dd.getcol("SPECTRAL_WINDOW_ID")
+    dd.close()
+    t = table(vis, ack=False)
+    columns = ["FLAG", "FLAG_ROW", "WEIGHT", "DATA_DESC_ID"]
+    if "WEIGHT_SPECTRUM" in t.colnames() and t.nrows() > 0 and t.iscelldefined("WEIGHT_SPECTRUM", 0):
+        columns.append("WEIGHT_SPECTRUM")
+    digests = {}
+    for sub, start, nrow, cols in iter_chunks(t, vis, columns):
+        for ddid in np.unique(cols["DATA_DESC_ID"]):
+            rows = cols["DATA_DESC_ID"] == ddid
+            digest = digests.setdefault(int(spw_ids[ddid]), hashlib.sha1())
+            digest.update(np.packbits(cols["FLAG"][rows]).tobytes())
+            digest.update(np.packbits(cols["FLAG_ROW"][rows]).tobytes())
+            for col in columns[4:] + ["WEIGHT"]:
+                mantissa, exponent = np.frexp(cols[col][rows])
+                digest.update(np.round(mantissa * 2**17).astype(np.int64).tobytes())
+                digest.update(exponent.astype(np.int32).tobytes())
+    t.close()
+    return {spw: digest.hexdigest() for spw, digest in digests.items()}
+
+
+def scan_windows(vis, field=""):
+    # Start and end (datetime64) of every scan in vis, one per (scan, field) and in time order.
+    # Windows cover whole integrations, i.e. TIME -/+ INTERVAL/2.
+    t = table(vis, ack=False)
+    sel = select_rows(t, vis, field=field_ids(vis, field))
+    scans = sel.getcol("SCAN_NUMBER")
+    fields = sel.getcol("FIELD_ID")
+    times = sel.getcol("TIME")
+    half = sel.getcol("INTERVAL") / 2
+    t.close()
+    fld = table(f"{vis}/FIELD", ack=False)
+    names = np.array(fld.getcol("NAME"))
+    fld.close()
+    if len(times) == 0:
+        raise ValueError(f"Nothing selected from {vis} with field={field}")
+    key = scans.astype(np.int64) * (fields.max() + 1) + fields
+    order = np.argsort(key, kind="stable")
+    first = np.concatenate([[0], np.flatnonzero(np.diff(key[order])) + 1])
+    start = np.minimum.reduceat((times - half)[order], first)
+    end = np.maximum.reduceat((times + half)[order], first)
+    by_time = np.argsort(start)
+    field_id = fields[order][first][by_time]
+    return {
+        "scan": scans[order][first][by_time],
+        "field_id": field_id,
+        "field": names[field_id],
+        "start": mjds_to_datetime64(start[by_time]),
+        "end": mjds_to_datetime64(end[by_time]),
+    }
+
+
+def scan_bins(windows, interval=30.0):
+    # Splits every scan window from scan_windows into interval second bins, the last one running past the end
+    # of the scan if it doesn't divide evenly. Also gives minutes since the first scan, for lightcurve time axes.
+    durations = (windows["end"] - windows["start"]) / np.timedelta64(1, "s")
+    nbins = np.maximum(np.ceil(durations / interval - 1e-6).astype(int), 1)
+    which = np.repeat(np.arange(len(nbins)), nbins)
+    within = np.arange(nbins.sum()) - np.repeat(np.cumsum(nbins) - nbins, nbins)
+    starts = windows["start"][which] + np.round(within * interval * 1e6).astype("timedelta64[us]")
+    return {
+        "start": starts,
+        "scan": windows["scan"][which],
+        "field": windows["field"][which],
+        "minutes": (starts - windows["start"][0]) / np.timedelta64(1, "m"),
+    }
+
+
+def epoch_windows(vis, field="", epoch_unit="M"):
+    # {epoch ("2020-01"): (start, end)} spanning the scans in each calendar month (epoch_unit="D" for days)
+    windows = scan_windows(vis, field)
+    labels = windows["start"].astype(f"datetime64[{epoch_unit}]").astype(str)
+    return {
+        str(label): (windows["start"][labels == label].min(), windows["end"][labels == label].max())
+        for label in np.unique(labels)
+    }
+
+
+def empty_copy(vis, outputvis):
+    # Same table structure and subtables as vis, but with no rows in the main table
+    workspace.remove(outputvis)
+    t = table(vis, ack=False)
+    out = t.copy(outputvis, deep=True, valuecopy=True, copynorows=True)
+    out.close()
+    # copynorows empties the subtables too, so copy those across in full
+    for name, value in t.getkeywords().items():
+        if isinstance(value, str) and value.startswith("Table: "):
+            sub = table(value[len("Table: "):], ack=False)
+            shutil.rmtree(f"{outputvis}/{name}")
+            sub.copy(f"{outputvis}/{name}", deep=True, valuecopy=True).close()
+            sub.close()
+    t.close()
+    return
+
+
+def split_epochs(visname, outputvis_fmt, datacolumn="data", field="", epoch_unit="M"):
+    # Splits visname into one ms per calendar month (epoch_unit="D" for days) in a single read of the ms,
+    # instead of one mstransform per epoch. outputvis_fmt takes {epoch} ("2020-01"), {year} and {month}.
+    # datacolumn="corrected" writes CORRECTED_DATA as DATA, like split. FIELD_IDs keep their original numbering.
+    t = table(visname, ack=False)
+    fields = field_ids(visname, field)
+    in_col = {"data": "DATA", "corrected": "CORRECTED_DATA"}[datacolumn]
+    sel = select_rows(t, visname, field=fields)
+    times = sel.getcol("TIME")
+    if len(times) == 0:
+        raise ValueError(f"Nothing selected from {visname} with field={field}")
+    labels = [str(label) for label in np.unique(mjds_to_datetime64(times).astype(f"datetime64[{epoch_unit}]"))]
+    print(f"Found epochs {', '.join(labels)} in {visname}")
+
+    outputs = {}
+    out_tables = {}
+    for label in labels:
+        outputvis = outputvis_fmt.format(epoch=label, year=label[0:4], month=label[5:7])
+        empty_copy(visname, outputvis)
+        out = table(outputvis, readonly=False, ack=False)
+        drop = [
+            col for col in ["DATA", "MODEL_DATA", "CORRECTED_DATA"] if col in out.colnames() and col != in_col
+        ]
+        out.removecols(drop)
+        if in_col != "DATA":
+            out.renamecol(in_col, "DATA")
+        outputs[label] = outputvis
+        out_tables[label] = out
+
+    # Column to read for each output column, skipping ones that were never filled (e.g. FLAG_CATEGORY)
+    out_cols = out_tables[labels[0]].colnames()
+    col_map = {col: (in_col if col == "DATA" else col) for col in out_cols}
+    col_map = {
+        col: src for col, src in col_map.items() if t.nrows() == 0 or t.iscelldefined(src, 0)
+    }
+    for sub, start, nrow, cols in iter_chunks(t, visname, sorted(set(col_map.values()) | {"TIME"}), field=fields):
+        chunk_labels = mjds_to_datetime64(cols["TIME"]).astype(f"datetime64[{epoch_unit}]").astype(str)
+        for label in np.unique(chunk_labels):
+            rows = chunk_labels == label
+            out = out_tables[label]
+            out_start = out.nrows()
+            out.addrows(int(rows.sum()))
+            for col, src in col_map.items():
+                out.putcol(col, cols[src][rows], out_start, int(rows.sum()))
+    for out in out_tables.values():
+        out.close()
+    t.close()
+    return outputs
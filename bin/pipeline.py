@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# Step graph used by run_process.py: each stage of process.py is declared with the files it reads and writes,
+# and is only rerun if its products are missing or older than its inputs (or anything upstream reran)
+
+import os
+import json
+import time
+
+
+# Lock files get touched by simply opening a table read-only, so they can't be used to judge freshness
+ignore_mtime = ["table.lock"]
+
+
+def step(name, func, args=(), kwargs=None, inputs=(), outputs=(), deps=(), stamp=None):
+    # stamp: file written when the step finishes, stages that only modify an MS in place rely on this alone
+    return {
+        "name": name,
+        "func": func,
+        "args": tuple(args),
+        "kwargs": dict(kwargs or {}),
+        "inputs": list(inputs),
+        "outputs": list(outputs),
+        "deps": list(deps),
+        "stamp": stamp,
+    }
+
+
+def newest_mtime(path):
+    # MSs, cal tables and images are directories, so look at everything inside them
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    newest = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            if fname in ignore_mtime:
+                continue
+            newest = max(newest, os.path.getmtime(os.path.join(root, fname)))
+    return newest
+
+
+def stamp_path(stamp_dir, stp):
+    if stp["stamp"] is not None:
+        return stp["stamp"]
+    return f"{stamp_dir}/{stp['name']}.done"
+
+
+def stale_reason(stp, stamp_dir, steps_by_name, rerun):
+    stamp = stamp_path(stamp_dir, stp)
+    for dep in stp["deps"]:
+        if dep in rerun:
+            return f"upstream step {dep} reran"
+    if not os.path.exists(stamp):
+        return "never completed"
+    done_time = os.path.getmtime(stamp)
+    for out in stp["outputs"]:
+        if not os.path.exists(out):
+            return f"missing output {out}"
+    for inp in stp["inputs"]:
+        inp_time = newest_mtime(inp)
+        if inp_time is None:
+            return f"missing input {inp}"
+        if inp_time > done_time:
+            return f"input {inp} changed"
+    for dep in stp["deps"]:
+        dep_stamp = stamp_path(stamp_dir, steps_by_name[dep])
+        if os.path.exists(dep_stamp) and os.path.getmtime(dep_stamp) > done_time:
+            return f"upstream step {dep} is newer"
+    return None
+
+
+def order_steps(steps):
+    # Simple topological sort, keeping the declared order wherever the dependencies allow it
+    steps_by_name = {stp["name"]: stp for stp in steps}
+    ordered = []
+    placed = set()
+
+    def visit(stp, chain):
+        if stp["name"] in placed:
+            return
+        if stp["name"] in chain:
+            raise ValueError(f"Dependency cycle through step {stp['name']}")
+        for dep in stp["deps"]:
+            if dep not in steps_by_name:
+                raise ValueError(f"Step {stp['name']} depends on unknown step {dep}")
+            visit(steps_by_name[dep], chain + [stp["name"]])
+        placed.add(stp["name"])
+        ordered.append(stp)
+
+    for stp in steps:
+        visit(stp, [])
+    return ordered
+
+
+def run_steps(steps, stamp_dir, selected=None, force=()):
+    # selected: names of the steps allowed to run (None means all), anything not selected is left alone
+    # force: names of steps to rerun regardless of timestamps, everything downstream follows
+    os.makedirs(stamp_dir, exist_ok=True)
+    steps = order_steps(steps)
+    steps_by_name = {stp["name"]: stp for stp in steps}
+    rerun = set()
+    for stp in steps:
+        name = stp["name"]
+        if selected is not None and name not in selected:
+            print(f"Step {name}: not selected, skipping")
+            continue
+        if name in force:
+            reason = "forced"
+        else:
+            reason = stale_reason(stp, stamp_dir, steps_by_name, rerun)
+        if reason is None:
+            print(f"Step {name}: up to date, skipping")
+            continue
+        print(f"Step {name}: running ({reason})")
+        start = time.time()
+        stp["func"](*stp["args"], **stp["kwargs"])
+        rerun.add(name)
+        stamp = stamp_path(stamp_dir, stp)
+        os.makedirs(os.path.dirname(stamp), exist_ok=True)
+        with open(stamp, "w") as stamp_file:
+            json.dump(
+                {"step": name, "reason": reason, "start": start, "wall_time": time.time() - start},
+                stamp_file,
+            )
+    return rerun
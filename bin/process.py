@@ -5,9 +5,14 @@
 
 # TODO: Make a try/else situation for if it tries to make a psf but can't, then try calibrating with a lower snr. Not sure about exact implementation though
 import os
+import glob
+import json
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from casacore.tables import table
 from casatasks import (
-    flagmanager,
     flagdata,
     mstransform,
     listobs,
@@ -21,57 +26,71 @@ from casatasks import (
     impbcor,
     split,
     uvmodelfit,
-    exportfits,
 )
 import numpy as np
+from scipy import ndimage
 from casaplotms import plotms
 import matplotlib.pyplot as plt
 from casatools import image as IA
-from astropy.wcs import WCS
 from astropy.visualization import simple_norm
+import ledger
+import tracing
+import workspace
+import msio
+import imgio
+import flagversions
+import flagplan
+import shards
+import uvfit
+import calcache
+import pipeline
+
+# Every CASA task call is timed and written to the trace file, if run_process.py has set one
+flagdata = tracing.traced(flagdata)
+mstransform = tracing.traced(mstransform)
+listobs = tracing.traced(listobs)
+setjy = tracing.traced(setjy)
+gaincal = tracing.traced(gaincal)
+bandpass = tracing.traced(bandpass)
+fluxscale = tracing.traced(fluxscale)
+applycal = tracing.traced(applycal)
+tclean = tracing.traced(tclean)
+rmtables = tracing.traced(rmtables)
+impbcor = tracing.traced(impbcor)
+split = tracing.traced(split)
+uvmodelfit = tracing.traced(uvmodelfit)
+write_fits = tracing.traced(imgio.write_fits)
 
 ia = IA()
 plt.rcParams["font.family"] = "serif"
 
 
-def buildImage(imname="", chan=0):
-    ia.open(imname)
-    pix = ia.getchunk()[:, :, 0, chan]
-    csys = ia.coordsys()
-    ia.close()
-
-    rad_to_deg = 180 / np.pi
-    w = WCS(naxis=2)
-    w.wcs.crpix = csys.referencepixel()["numeric"][0:2]
-    w.wcs.cdelt = csys.increment()["numeric"][0:2] * rad_to_deg
-    w.wcs.crval = csys.referencevalue()["numeric"][0:2] * rad_to_deg
-    w.wcs.ctype = ["RA---SIN", "DEC--SIN"]
+def buildImage(imname="", chan=0, blc=None, trc=None):
+    # Plane chan of the image (or the blc to trc window of it) and its WCS, see imgio.read_region
+    return imgio.read_region(imname, blc=blc, trc=trc, chan=chan)
 
-    return pix, w
 
-
-def flag_ms(visname):  # , rawname1, rawname2, rawname3):
-    print("Flagging antennas affected by shadowing...")
+def flag_ms(visname, engine="numpy"):  # , rawname1, rawname2, rawname3):
+    # engine="numpy" does the shadow/zero/quack flagging in one pass (see flagging.py), "casa" in one flagdata list
     # importatca(
     #     vis=visname, files=[rawname1, rawname2, rawname3], options="birdie,noac", edge=4
     # )
-    flagmanager(vis=visname, mode="save", versionname="before_online_flagging")
-    print("Flagging antennas affected by shadowing...")
-    flagdata(vis=visname, mode="shadow", tolerance=0.0, flagbackup=False)
-    print("Flagging visibilities with zero amplitudes...")
-    flagdata(vis=visname, mode="clip", clipzeros=True, flagbackup=False)
-    print("Quacking visibilities ...")
-    flagdata(
-        vis=visname, mode="quack", quackinterval=5.0, quackmode="beg", flagbackup=False
-    )
-    flagmanager(vis=visname, mode="save", versionname="after_online_flagging")
+    flagversions.save(visname, "before_online_flagging")
+    print("Flagging shadowed antennas, zero amplitudes and scan starts...")
+    plan = flagplan.new_plan("flag_ms")
+    flagplan.add(plan, visname, mode="shadow", tolerance=0.0)
+    flagplan.add(plan, visname, mode="clip", clipzeros=True)
+    flagplan.add(plan, visname, mode="quack", quackinterval=5.0, quackmode="beg")
+    flagplan.run(plan, engine)
+    # Also the backup of the flags from before tfcrop, in place of flagdata's own flagmanager copy
+    flagversions.save(visname, "after_online_flagging")
     flagdata(
         vis=visname,
         mode="tfcrop",
         datacolumn="data",
         action="apply",
         display="report",
-        flagbackup=True,
+        flagbackup=False,
         extendpols=True,
         correlation="",
         flagdimension="freqtime",
@@ -118,10 +137,20 @@ def split_epochms(data_dir, tar, epoch, ATCA_band):
     return
 
 
+def split_epochms_all(data_dir, tar, ATCA_band):
+    # Every epoch of split_epochms in one read of the ms, epochs are the months found in the data
+    visname = f"{data_dir}data/{tar}_{ATCA_band}.ms"
+    outputs = msio.split_epochs(
+        visname, "{year}_{month}_" + f"{tar}_{ATCA_band}.ms", datacolumn="data"
+    )
+    return outputs
+
+
 def split_ms(src_dir, img_dir, visname, msname, ATCA_band, pri, sec, tar, n_spw):
-    os.system(f"rm -r {msname}")
-    os.system(f"rm -r {msname}.flagversions")
-    os.system("rm -r *.last")
+    workspace.remove(msname)
+    workspace.remove(f"{msname}.flagversions")
+    workspace.remove(flagversions.store_dir(msname))
+    workspace.remove("*.last")
     # have removed n_spw for mstransform and included it in the split just before imaging
     mstransform(
         vis=visname,
@@ -138,173 +167,172 @@ def split_ms(src_dir, img_dir, visname, msname, ATCA_band, pri, sec, tar, n_spw)
         listfile=f"{src_dir}/listobs_{ATCA_band}_{tar}.dat",
         overwrite=True,
     )
-    flagmanager(vis=msname, mode="save", versionname="after_transform")
+    flagversions.save(msname, "after_transform")
     return
 
 
-def calibrate_ms(src_dir, msname, ATCA_band, ref, pri, sec, tar):
-    os.system(f"rm -r {src_dir}/cal_tables/cal_{pri}_{ATCA_band}.F0")
+def calibrate_ms(src_dir, msname, ATCA_band, ref, pri, sec, tar, cache_dir=None):
+    # With a cache_dir, tables already solved from identical calibrator data and settings are linked in instead
+    cal_dir = f"{src_dir}/cal_tables"
+    cal_names = [f"cal_{pri}_{ATCA_band}.{ext}" for ext in ["G0", "B0", "G1", "B1", "G2", "F0"]]
+    # Every setting the solves are made with, which is also what goes into the cache key
+    gain_solve = {"gaintype": "G", "calmode": "ap"}
+    band_solve = {"solnorm": True, "solint": "120s", "bandtype": "B"}
+    cal_params = {
+        "band": ATCA_band,
+        "standard": "Perley-Butler 2010",
+        "common": {"refant": ref, "parang": True},
+        "G0": dict(gain_solve, calmode="p", solint="60s"),
+        "B0": band_solve,
+        "G1": dict(gain_solve, solint="120s"),
+        "B1": band_solve,
+        "G2": dict(gain_solve, solint="60s"),
+    }
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        key = calcache.cal_key(msname, [pri, sec], cal_params)
+        entry = calcache.lookup(cache_dir, key, cal_names)
+        if entry is not None:
+            print(f"Found calibration tables for {pri}/{sec} in the cache, skipping the solve")
+            calcache.link_tables(entry, cal_names, cal_dir)
+            flagversions.save(msname, "before_applycal")
+            return
+        solve_dir = calcache.staging_dir(cache_dir, key)
+    else:
+        solve_dir = cal_dir
+    # Tables left by an earlier run may be links into the cache, which solving in place would write through
+    for name in cal_names:
+        workspace.remove(f"{solve_dir}/{name}")
     setjy(
         vis=msname,
         field=pri,
         scalebychan=True,
-        standard="Perley-Butler 2010",
+        standard=cal_params["standard"],
         usescratch=True,
     )
     print(f"Performing gain calibration on {pri}")
     gaincal(
         vis=msname,
-        caltable=f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.G0",
+        caltable=f"{solve_dir}/cal_{pri}_{ATCA_band}.G0",
         field=pri,
-        refant=ref,
-        gaintype="G",
-        calmode="p",
-        parang=True,
+        **cal_params["common"],
+        **cal_params["G0"],
         # minblperant=3,
-        solint="60s",
     )
     print(f"Performing bandpass calibration on {pri}")
     bandpass(
         vis=msname,
-        caltable=f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B0",
+        caltable=f"{solve_dir}/cal_{pri}_{ATCA_band}.B0",
         field=pri,
-        refant=ref,
-        solnorm=True,
-        solint="120s",
-        bandtype="B",
-        gaintable=[f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.G0"],
-        parang=True,
+        gaintable=[f"{solve_dir}/cal_{pri}_{ATCA_band}.G0"],
+        **cal_params["common"],
+        **cal_params["B0"],
     )
     print(f"Determining gains on {sec}")
     gaincal(
         vis=msname,
-        caltable=f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.G1",
+        caltable=f"{solve_dir}/cal_{pri}_{ATCA_band}.G1",
         field=pri + "," + sec,
-        refant=ref,
-        gaintype="G",
-        calmode="ap",
-        parang=True,
-        solint="120s",
-        gaintable=[f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B0"],
+        gaintable=[f"{solve_dir}/cal_{pri}_{ATCA_band}.B0"],
+        **cal_params["common"],
+        **cal_params["G1"],
     )
     bandpass(
         vis=msname,
-        caltable=f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B1",
+        caltable=f"{solve_dir}/cal_{pri}_{ATCA_band}.B1",
         field=pri,
-        refant=ref,
-        solnorm=True,
-        solint="120s",
-        bandtype="B",
-        gaintable=[f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.G1"],
-        parang=True,
+        gaintable=[f"{solve_dir}/cal_{pri}_{ATCA_band}.G1"],
+        **cal_params["common"],
+        **cal_params["B1"],
     )
     print(f"Deriving gain calibration using {pri}")
     gaincal(
         vis=msname,
-        caltable=f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.G2",
+        caltable=f"{solve_dir}/cal_{pri}_{ATCA_band}.G2",
         field=pri,
-        refant=ref,
-        gaintype="G",
-        calmode="ap",
-        parang=True,
-        solint="60s",
+        gaintable=[f"{solve_dir}/cal_{pri}_{ATCA_band}.B1"],
+        **cal_params["common"],
+        **cal_params["G2"],
         # minblperant=3,
-        gaintable=[f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B1"],
     )
     print(f"Deriving gain calibration using {sec}")
     gaincal(
         vis=msname,
-        caltable=f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.G2",
+        caltable=f"{solve_dir}/cal_{pri}_{ATCA_band}.G2",
         field=sec,
-        refant=ref,
-        gaintype="G",
-        calmode="ap",
-        parang=True,
-        solint="60s",
-        # minblperant=3,
-        gaintable=[f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B1"],
+        gaintable=[f"{solve_dir}/cal_{pri}_{ATCA_band}.B1"],
         append=True,
+        **cal_params["common"],
+        **cal_params["G2"],
+        # minblperant=3,
     )
     print(
         "Correcting the flux scale using comparison between the primary and secondary calibrator."
     )
     fluxscale(
         vis=msname,
-        caltable=f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.G2",
-        fluxtable=f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.F0",
+        caltable=f"{solve_dir}/cal_{pri}_{ATCA_band}.G2",
+        fluxtable=f"{solve_dir}/cal_{pri}_{ATCA_band}.F0",
         reference=pri,
     )
-    flagmanager(vis=msname, mode="save", versionname="before_applycal")
+    if cache_dir is not None:
+        entry = calcache.publish(cache_dir, key, solve_dir, cal_names)
+        calcache.link_tables(entry, cal_names, cal_dir)
+    flagversions.save(msname, "before_applycal")
     return
 
 
-def applycal_ms(src_dir, msname, ATCA_band, pri, sec, tar):
-    applycal(
-        vis=msname,
-        gaintable=[
-            f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B1",
-            f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.F0",
-        ],
-        gainfield=[pri, pri, pri],
-        field=f"{pri}",
-        parang=True,
-        flagbackup=False,
-    )
-    applycal(
-        vis=msname,
-        gaintable=[
-            f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B1",
-            f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.F0",
-        ],
-        gainfield=[pri, pri, sec],
-        field=f"{sec},{tar}",
-        parang=True,
-        flagbackup=False,
-    )
+def applycal_shard(shard, calls, stage):
+    # Worker for the applycal steps: every applycal call on one shard of the ms (or the whole ms) that selects any
+    # of its rows
+    with tracing.stage(stage):
+        for kwargs in calls:
+            if shards.has_rows(shard, kwargs.get("field", "")):
+                applycal(vis=shard, **kwargs)
     return
 
 
-def flagcal_ms(img_dir, msname, ATCA_band, pri, sec):
-    flagmanager(vis=msname, mode="save", versionname="before_rflag")
-    flagdata(
-        vis=msname,
-        mode="rflag",
-        field=pri,
-        datacolumn="corrected",
-        action="apply",
-        display="report",
-        correlation="ABS_ALL",
-        timedevscale=3.0,
-        freqdevscale=3.0,
-        winsize=3,
-        combinescans=True,
-        ntime="9999999min",
-        extendflags=False,
-        flagbackup=False,
-    )
-    flagdata(
-        vis=msname,
-        mode="rflag",
-        field=sec,
-        datacolumn="corrected",
-        action="apply",
-        display="report",
-        correlation="ABS_ALL",
-        timedevscale=3.0,
-        freqdevscale=3.0,
-        winsize=3,
-        combinescans=True,
-        ntime="9999999min",
-        extendflags=False,
-        flagbackup=False,
-    )
-    flagdata(
-        vis=msname,
+def applycal_ms(src_dir, msname, ATCA_band, pri, sec, tar, n_workers=1):
+    # If msname has been partitioned (see shards.py) n_workers shards are calibrated at once
+    gaintable = [
+        f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B1",
+        f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.F0",
+    ]
+    calls = [
+        {
+            "gaintable": gaintable,
+            "gainfield": [pri, pri, pri],
+            "field": f"{pri}",
+            "parang": True,
+            "flagbackup": False,
+        },
+        {
+            "gaintable": gaintable,
+            "gainfield": [pri, pri, sec],
+            "field": f"{sec},{tar}",
+            "parang": True,
+            "flagbackup": False,
+        },
+    ]
+    shards.map_shards(applycal_shard, msname, calls, "applycal_ms", n_workers=n_workers)
+    return
+
+
+def flagcal_ms(img_dir, msname, ATCA_band, pri, sec, tar=None, engine="numpy", n_workers=1):
+    # rflags pri, sec and (if given) tar, which applycal_ms has already calibrated, then extends the calibrator
+    # flags. engine="numpy" does the rflag in the same sweeps of the corrected data for every field, a chunk at a time
+    # (see flagging.rflag), "casa" runs all of it as one flagdata list. A partitioned ms is flagged n_workers shards
+    # at a time.
+    flagversions.save(msname, "before_rflag")
+    plan = flagplan.new_plan("flagcal_ms")
+    for fld in [pri, sec, tar]:
+        if fld:
+            flagplan.add(plan, msname, **rflag_params(fld))
+    flagplan.add(
+        plan,
+        msname,
         mode="extend",
         field=pri + "," + sec,
-        action="apply",
-        display="report",
-        flagbackup=False,
         extendpols=True,
         correlation="",
         growtime=95.0,
@@ -315,38 +343,44 @@ def flagcal_ms(img_dir, msname, ATCA_band, pri, sec):
         combinescans=True,
         ntime="9999999min",
     )
-
+    shards.run_plan(plan, engine, n_workers)
     return
 
 
-def flagcaltar_ms(src_dir, msname, ATCA_band, pri, sec, tar):
-    applycal(
-        vis=msname,
-        gaintable=[
-            f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B1",
-            f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.F0",
-        ],
-        gainfield=[pri, pri, sec],
-        field=tar,
-        parang=True,
-        flagbackup=False,
-    )
-    flagdata(
-        vis=msname,
-        mode="rflag",
-        field=tar,
-        datacolumn="corrected",
-        action="apply",
-        display="report",
-        correlation="ABS_ALL",
-        timedevscale=3.0,
-        freqdevscale=3.0,
-        winsize=3,
-        combinescans=True,
-        ntime="9999999min",
-        extendflags=False,
-        flagbackup=False,
-    )
+def rflag_params(field):
+    return {
+        "mode": "rflag",
+        "field": field,
+        "datacolumn": "corrected",
+        "correlation": "ABS_ALL",
+        "timedevscale": 3.0,
+        "freqdevscale": 3.0,
+        "winsize": 3,
+        "combinescans": True,
+        "ntime": "9999999min",
+        "extendflags": False,
+    }
+
+
+def flagcaltar_ms(src_dir, msname, ATCA_band, pri, sec, tar, rflag_tar=False, engine="numpy", n_workers=1):
+    # tar is normally rflagged along with the calibrators in flagcal_ms, rflag_tar=True flags it here instead
+    calls = [
+        {
+            "gaintable": [
+                f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.B1",
+                f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.F0",
+            ],
+            "gainfield": [pri, pri, sec],
+            "field": tar,
+            "parang": True,
+            "flagbackup": False,
+        }
+    ]
+    shards.map_shards(applycal_shard, msname, calls, "flagcaltar_ms", n_workers=n_workers)
+    if rflag_tar:
+        plan = flagplan.new_plan("flagcaltar_ms")
+        flagplan.add(plan, msname, **rflag_params(tar))
+        shards.run_plan(plan, engine, n_workers)
     return
 
 
@@ -358,7 +392,7 @@ def split_imgms(data_dir, tar, epoch, ATCA_band, n_spw):
     visname = f"{data_dir}data/2020_{tar}_{ATCA_band}.ms"
     outputvis = f"{data_dir}data/2020-{epoch}_{tar}_{ATCA_band}.ms"
     if os.path.exists(outputvis):
-        os.system(f"rm -r {outputvis}*")
+        workspace.remove(f"{outputvis}*")
     mstransform(
         vis=visname,
         outputvis=outputvis,
@@ -375,7 +409,56 @@ def split_imgms(data_dir, tar, epoch, ATCA_band, n_spw):
     return
 
 
-def imgmfs_ms(src_dir, imagems, imagename, ATCA_band, n_spw):
+def split_imgms_epochs(data_dir, tar, ATCA_band, n_spw):
+    # Same outputs as calling split_imgms for each epoch, but the ms is only read once
+    visname = f"{data_dir}data/2020_{tar}_{ATCA_band}.ms"
+    outputs = msio.split_epochs(
+        visname,
+        f"{data_dir}data/" + "{epoch}_" + f"{tar}_{ATCA_band}.ms",
+        datacolumn="corrected",
+        field=tar,
+    )
+    for label, outputvis in outputs.items():
+        listobs(
+            vis=outputvis,
+            listfile=f"{data_dir}{tar}/listobs_{label}_{tar}_{ATCA_band}_preimage.dat",
+            overwrite=True,
+        )
+    return outputs
+
+
+def threshold_mask(image, psf, mask, nsigma=5.0, sidelobe_factor=1.0, grow=5):
+    # Mask of every pixel of image above nsigma times its rms (from the median absolute deviation) and above the
+    # peak's brightest psf sidelobe times sidelobe_factor, grown by grow pixels in the image plane. Written as a
+    # CASA image tclean can take as its mask.
+    ia.open(psf)
+    beam = ia.getchunk()
+    ia.close()
+    # The psf's main lobe is the positive region around its peak, anything outside it is sidelobe
+    lobes, _ = ndimage.label(beam > 0)
+    sidelobe = beam[lobes != lobes[np.unravel_index(np.argmax(beam), beam.shape)]].max(initial=0.0)
+    ia.open(image)
+    pix = ia.getchunk()
+    ia.close()
+    rms = 1.4826 * np.nanmedian(np.abs(pix - np.nanmedian(pix)))
+    cut = max(nsigma * rms, sidelobe_factor * sidelobe * np.nanmax(pix))
+    region = pix > cut
+    structure = ndimage.generate_binary_structure(2, 1).reshape(3, 3, *([1] * (pix.ndim - 2)))
+    region = ndimage.binary_dilation(region, structure=structure, iterations=grow)
+    workspace.remove(mask)
+    ia.fromimage(outfile=mask, infile=image, overwrite=True)
+    ia.close()
+    ia.open(mask)
+    ia.putchunk(region.astype(float))
+    ia.close()
+    print(f"Masked {int(region.sum())} pixels above {cut:.2e}Jy (rms {rms:.2e}Jy, psf sidelobe {sidelobe:.2f})")
+    return
+
+
+def imgmfs_ms(src_dir, imagems, imagename, ATCA_band, n_spw, masking="auto-multithresh"):
+    # Makes the {imagename}_mfs.mask that img_ms and slefcal_ms clean within. masking:
+    # "auto-multithresh": tclean's automasking, "threshold": everything above 5 sigma in the dirty image grown by a
+    # few pixels, "interactive": drawn by hand in the viewer, which needs someone at the screen
     mode = "mfs"
     nterms = 1
     niter = 3000
@@ -397,57 +480,272 @@ def imgmfs_ms(src_dir, imagems, imagename, ATCA_band, n_spw):
     stokes = "I"
     weighting = "briggs"
     robust = 0.5
-    interactive = True
+    interactive = masking == "interactive"
     gain = 0.01
-    # if os.path.exists(f"{src_dir}/casa_files/{imagename}_mfs*"):
-    os.system(f"rm -r {src_dir}/casa_files/{imagename}_mfs*")
-    flagmanager(vis=imagems, mode="save", versionname="before_selfcal")
-    print("Initiating interactive cleaning on {0}".format(imagename))
+    mfs_name = f"{src_dir}/casa_files/{imagename}_mfs"
+    workspace.remove_product(mfs_name)
+    flagversions.save(imagems, "before_selfcal")
+    clean_pars = {
+        "gain": gain,
+        "specmode": mode,
+        "nterms": nterms,
+        "threshold": threshold,
+        "imsize": imsize,
+        "cell": cell,
+        "stokes": stokes,
+        "weighting": weighting,
+        "robust": robust,
+        "antenna": antenna,
+        "interactive": interactive,
+        "savemodel": "modelcolumn",
+        "pbcor": False,
+        "uvrange": uvrange,
+    }
+    if masking == "interactive":
+        print("Initiating interactive cleaning on {0}".format(imagename))
+        tclean(vis=imagems, imagename=workspace.staged(mfs_name), niter=niter, **clean_pars)
+    elif masking == "auto-multithresh":
+        print(f"Cleaning {imagename} with automasking")
+        # ATCA's psf has strong sidelobes, so the sidelobe threshold is on the low side of tclean's range
+        tclean(
+            vis=imagems,
+            imagename=workspace.staged(mfs_name),
+            niter=niter,
+            usemask="auto-multithresh",
+            sidelobethreshold=1.25,
+            noisethreshold=5.0,
+            lownoisethreshold=1.5,
+            minbeamfrac=0.3,
+            growiterations=75,
+            **clean_pars,
+        )
+        ia.open(f"{workspace.staged(mfs_name)}.mask")
+        found = ia.getchunk().any()
+        ia.close()
+        if not found:
+            print(f"Automasking found nothing in {imagename}, masking from the dirty image instead")
+            workspace.remove_product(mfs_name)
+            masking = "threshold"
+    elif masking != "threshold":
+        raise ValueError(f"Unknown masking {masking}, use auto-multithresh, threshold or interactive")
+    if masking == "threshold":
+        print(f"Cleaning {imagename} within a mask from its dirty image")
+        tclean(vis=imagems, imagename=workspace.staged(mfs_name), niter=0, **clean_pars)
+        threshold_mask(
+            f"{workspace.staged(mfs_name)}.image",
+            f"{workspace.staged(mfs_name)}.psf",
+            f"{workspace.staged(mfs_name)}.threshold_mask",
+        )
+        # Carries on from the dirty image, the psf and residual are already made
+        tclean(
+            vis=imagems,
+            imagename=workspace.staged(mfs_name),
+            niter=niter,
+            mask=f"{workspace.staged(mfs_name)}.threshold_mask",
+            calcpsf=False,
+            calcres=False,
+            **clean_pars,
+        )
+    tclean(
+        vis=imagems,
+        imagename=workspace.staged(mfs_name),
+        niter=0,
+        calcres=False,
+        calcpsf=False,
+        **clean_pars,
+    )
+    workspace.promote(mfs_name)
+    ia.open(f"{mfs_name}.mask")
+    if not ia.getchunk().any():
+        print(f"Warning: {mfs_name}.mask is empty, nothing will be cleaned")
+    ia.close()
+    return
+
+
+# tclean parameters that shape the psf, sumwt and pb. Between rounds where these, the flags and the weights stay the
+# same (self cal only changes the gains) the previous round's psf is reused.
+psf_params = [
+    "imsize",
+    "cell",
+    "stokes",
+    "specmode",
+    "nterms",
+    "deconvolver",
+    "gridder",
+    "weighting",
+    "robust",
+    "uvtaper",
+    "antenna",
+    "uvrange",
+    "phasecenter",
+]
+psf_exts = [".psf", ".sumwt", ".pb"]
+
 
+def psf_key(clean_pars, spw, data_digest):
+    key = {par: clean_pars[par] for par in psf_params if par in clean_pars}
+    return json.loads(json.dumps(dict(key, spw=spw, data=data_digest)))
+
+
+def psf_key_file(imagename):
+    # Kept with the psf on scratch, and cleared along with it
+    return f"{workspace.staged(imagename)}.imaging_key.json"
+
+
+def reusable_psf(imagename, key):
+    # Whether imagename's psf was made with the same geometry from the same flags and weights
+    key_file = psf_key_file(imagename)
+    if not os.path.exists(key_file) or not glob.glob(f"{workspace.locate(imagename + '.psf')}*"):
+        return False
+    with open(key_file) as stored:
+        return json.load(stored) == key
+
+
+def clean_spw(
+    imagems, imagename, spw, clean_pars, mask="", startmodel="", savemodel="modelcolumn", psf_from=None, key=None
+):
+    # imagename is where the final products end up, the clean itself runs on scratch if staging is on
+    # If imagems is partitioned by spw only the shard holding spw is read
+    # psf_from: earlier image whose psf, sumwt and pb can stand in for this one's, key: what this psf depends on
+    workspace.remove_product(imagename)
+    if psf_from is not None:
+        print(f"Reusing the psf of {psf_from}")
+        workspace.copy_products(psf_from, imagename, psf_exts)
+    print("Cleaning on band: " + str(spw))
     tclean(
         vis=imagems,
-        imagename=f"{src_dir}/casa_files/{imagename}_mfs",
-        gain=gain,
-        specmode=mode,
-        nterms=nterms,
-        niter=niter,
-        threshold=threshold,
-        imsize=imsize,
-        cell=cell,
-        stokes=stokes,
-        weighting=weighting,
-        robust=robust,
-        antenna=antenna,
-        interactive=interactive,
-        savemodel="modelcolumn",
-        pbcor=False,
-        uvrange=uvrange,
+        imagename=workspace.staged(imagename),
+        selectdata=True,
+        mask=mask,
+        spw=spw,
+        startmodel=startmodel,
+        savemodel=savemodel,
+        calcpsf=psf_from is None,
+        **clean_pars,
     )
+    if key is not None:
+        with open(psf_key_file(imagename), "w") as key_file:
+            json.dump(key, key_file)
+    return
+
+
+def predict_spw(imagems, imagename, spw, clean_pars):
+    # Writes the clean model for this spw into MODEL_DATA, without touching the psf or residual
+    # then moves the final products out of scratch
+    pars = dict(clean_pars, niter=0)
     tclean(
         vis=imagems,
-        imagename=f"{src_dir}/casa_files/{imagename}_mfs",
-        gain=gain,
-        specmode=mode,
-        nterms=nterms,
-        niter=0,
-        threshold=threshold,
-        imsize=imsize,
-        cell=cell,
-        stokes=stokes,
-        weighting=weighting,
-        robust=robust,
-        antenna=antenna,
-        interactive=interactive,
+        imagename=workspace.staged(imagename),
+        selectdata=True,
+        mask="",
+        spw=spw,
         savemodel="modelcolumn",
-        pbcor=False,
         calcres=False,
         calcpsf=False,
-        uvrange=uvrange,
+        **pars,
     )
+    workspace.promote(imagename)
     return
 
 
-def img_ms(src_dir, imagems, imagename, ATCA_band, n_spw):
+def image_spws(
+    src_dir,
+    imagems,
+    imagename,
+    ext,
+    n_spw,
+    clean_pars,
+    prev_ext=None,
+    n_workers=1,
+    ledger_file=None,
+    stage=None,
+    upstream=(),
+):
+    # Images every spw as {imagename}_{spw}_{ext}, starting from the {prev_ext} model if given.
+    # With n_workers > 1 the deconvolution of each spw runs in its own process without touching the ms,
+    # then the models are written to the shared MODEL_DATA column one spw at a time once they've all finished.
+    # If a ledger is given, spws already finished with the same parameters are skipped, returns their records
+    jobs = []
+    data_digests = msio.flag_weight_digests(imagems)
+    for i in range(0, n_spw):
+        spw = str(i)
+        startmodel = ""
+        prev_record = None
+        if prev_ext is not None:
+            startmodel = f"{src_dir}/casa_files/{imagename}_{spw}_{prev_ext}.model"
+            if ledger_file is not None:
+                prev_record = ledger.get_record(ledger_file, f"{stage}/{prev_ext}_spw{spw}")
+        job = {
+            "imagename": f"{src_dir}/casa_files/{imagename}_{spw}_{ext}",
+            "spw": spw,
+            "mask": f"{src_dir}/casa_files/{imagename}_mfs.mask",
+            "startmodel": startmodel,
+            "unit": f"{stage}/{ext}_spw{spw}",
+            "key": psf_key(clean_pars, spw, data_digests.get(i)),
+            "psf_from": None,
+        }
+        prev_imagename = f"{src_dir}/casa_files/{imagename}_{spw}_{prev_ext}"
+        if prev_ext is not None and reusable_psf(prev_imagename, job["key"]):
+            job["psf_from"] = prev_imagename
+        if ledger_file is not None:
+            job["fingerprint"] = ledger.fingerprint(
+                dict(clean_pars, vis=imagems, mask=job["mask"], startmodel=startmodel),
+                list(upstream) + [prev_record],
+            )
+            if ledger.is_done(ledger_file, job["unit"], job["fingerprint"]) and glob.glob(
+                f"{job['imagename']}.image*"
+            ):
+                print(f"Already cleaned {job['imagename']}, skipping")
+                continue
+        jobs.append(job)
+
+    if n_workers <= 1:
+        for job in jobs:
+            clean_spw(
+                imagems,
+                job["imagename"],
+                job["spw"],
+                clean_pars,
+                job["mask"],
+                job["startmodel"],
+                psf_from=job["psf_from"],
+                key=job["key"],
+            )
+            predict_spw(imagems, job["imagename"], job["spw"], clean_pars)
+            if ledger_file is not None:
+                ledger.mark_done(ledger_file, job["unit"], job["fingerprint"])
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+            futures = [
+                executor.submit(
+                    clean_spw,
+                    imagems,
+                    job["imagename"],
+                    job["spw"],
+                    clean_pars,
+                    job["mask"],
+                    job["startmodel"],
+                    "none",
+                    job["psf_from"],
+                    job["key"],
+                )
+                for job in jobs
+            ]
+            # Raise any worker failure before anything is written back to the ms
+            for future in futures:
+                future.result()
+        for job in jobs:
+            predict_spw(imagems, job["imagename"], job["spw"], clean_pars)
+            if ledger_file is not None:
+                ledger.mark_done(ledger_file, job["unit"], job["fingerprint"])
+
+    if ledger_file is None:
+        return []
+    return [ledger.get_record(ledger_file, f"{stage}/{ext}_spw{i}") for i in range(n_spw)]
+
+
+def img_ms(src_dir, imagems, imagename, ATCA_band, n_spw, n_workers=1):
     print(
         "+ + + + + + + + + + + + + + + + +\n+  Preself Imaging  +\n+ + + + + + + + + + + + + + + + +"
     )
@@ -473,66 +771,81 @@ def img_ms(src_dir, imagems, imagename, ATCA_band, n_spw):
     threshold = "5e-3Jy"
     uvrange = ""
     # flagmanager(vis=imagems, mode="save", versionname="preself")
-    for i in range(0, n_spw):
-        spw = str(i)
-        print("Cleaning on band: " + str(spw))
-        # if os.path.exists(f"{src_dir}/casa_files/{imagename}_{spw}_preself*"):
-        os.system(
-            f"rm -r {src_dir}/casa_files/{imagename}_{spw}_preself*"
-        )
-        tclean(
-            vis=imagems,
-            imagename=f"{src_dir}/casa_files/{imagename}_{spw}_preself",
-            selectdata=True,
-            mask=f"{src_dir}/casa_files/{imagename}_mfs.mask",
-            spw=spw,
-            gain=gain,
-            specmode=mode,
-            nterms=nterms,
-            niter=niter,
-            threshold=threshold,
-            imsize=imsize,
-            cell=cell,
-            stokes=stokes,
-            weighting=weighting,
-            robust=robust,
-            antenna=antenna,
-            interactive=interactive,
-            savemodel="modelcolumn",
-            pbcor=False,
-            uvrange=uvrange,
-        )
-        tclean(
-            vis=imagems,
-            imagename=f"{src_dir}/casa_files/{imagename}_{spw}_preself",
-            selectdata=True,
-            mask="",
-            spw=spw,
-            gain=gain,
-            specmode=mode,
-            nterms=nterms,
-            niter=0,
-            threshold=threshold,
-            imsize=imsize,
-            cell=cell,
-            stokes=stokes,
-            weighting=weighting,
-            robust=robust,
-            antenna=antenna,
-            interactive=interactive,
-            pbcor=False,
-            savemodel="modelcolumn",
-            calcres=False,
-            calcpsf=False,
-            uvrange=uvrange,
-        )
+    clean_pars = {
+        "gain": gain,
+        "specmode": mode,
+        "nterms": nterms,
+        "niter": niter,
+        "threshold": threshold,
+        "imsize": imsize,
+        "cell": cell,
+        "stokes": stokes,
+        "weighting": weighting,
+        "robust": robust,
+        "antenna": antenna,
+        "interactive": interactive,
+        "pbcor": False,
+        "uvrange": uvrange,
+    }
+    ledger_file = ledger.ledger_path(src_dir, imagename)
+    image_spws(
+        src_dir,
+        imagems,
+        imagename,
+        "preself",
+        n_spw,
+        clean_pars,
+        n_workers=n_workers,
+        ledger_file=ledger_file,
+        stage="img",
+    )
+    ledger.clear_stage(ledger_file, "img")
     return
 
 
-def slefcal_ms(src_dir, imagems, imagename, ATCA_band, n_spw):
-    print(
-        "+ + + + + + + + + + + + + + + + +\n+  Self Cal Round 1  +\n+ + + + + + + + + + + + + + + + +"
-    )
+def image_stats(imname):
+    # Peak of the image and rms of the residual (from the median absolute deviation, so the source doesn't count)
+    # imname without extension, taylor term images (.image.tt0) are used if that's what tclean made
+    stats = {}
+    for ext, key in [(".image", "peak"), (".residual", "rms")]:
+        path = workspace.locate(f"{imname}{ext}")
+        if not os.path.exists(path):
+            path = workspace.locate(f"{imname}{ext}.tt0")
+        ia.open(path)
+        pix = ia.getchunk()
+        ia.close()
+        if key == "peak":
+            stats[key] = float(np.nanmax(pix))
+        else:
+            stats[key] = float(1.4826 * np.nanmedian(np.abs(pix - np.nanmedian(pix))))
+    return stats
+
+
+def round_improvement(prev_stats, stats):
+    # Largest fractional improvement (rms down or peak up) over the spws, self cal has converged once it's small
+    gains = []
+    for prev, cur in zip(prev_stats, stats):
+        gains.append((prev["rms"] - cur["rms"]) / prev["rms"] if prev["rms"] > 0 else 0.0)
+        gains.append((cur["peak"] - prev["peak"]) / abs(prev["peak"]) if prev["peak"] != 0 else 0.0)
+    return max(gains)
+
+
+def selfcal_summary_path(src_dir, imagename):
+    # Rounds run and the extension of the final images, e.g. {"final": "self2", ...}
+    return f"{src_dir}/casa_files/{imagename}_selfcal.json"
+
+
+def final_selfcal_ext(src_dir, imagename):
+    summary_path = selfcal_summary_path(src_dir, imagename)
+    if not os.path.exists(summary_path):
+        return "self3"
+    with open(summary_path) as summary:
+        return json.load(summary)["final"]
+
+
+def slefcal_ms(src_dir, imagems, imagename, ATCA_band, n_spw, n_workers=1, max_rounds=3, min_improvement=0.02):
+    # Rounds of phase self cal until no spw's residual rms or peak improves by min_improvement (fractionally) on the
+    # round before, or max_rounds is reached. Each round's image stats and wall time go to selfcal_{imagename}.jsonl
     mode = "mfs"
     nterms = 2
     niter = 3000
@@ -562,308 +875,232 @@ def slefcal_ms(src_dir, imagems, imagename, ATCA_band, n_spw):
     robust = 0.5
     interactive = False
     gain = 0.01
-    threshold = "5e-4Jy"
-    # if os.path.exists(f"{src_dir}/cal_tables/pcal1_{imagename}"):
-    rmtables(f"{src_dir}/cal_tables/pcal1_{imagename}")
-    gaincal(
-        vis=imagems,
-        caltable=f"{src_dir}/cal_tables/pcal1_{imagename}",
-        combine="scan,spw",
-        spwmap=[0] * n_spw,
-        gaintype="G",
-        calmode="p",
-        solint=solint,
-        minsnr=minsnr,
-        minblperant=minblperant,
-    )
-    applycal(
-        vis=imagems,
-        gaintable=f"{src_dir}/cal_tables/pcal1_{imagename}",
-        spwmap=[0] * n_spw,
-        parang=True,
-        applymode="calonly",
-        flagbackup=False,
-    )
-    flagmanager(vis=imagems, mode="save", versionname="post self1")
-
-    for i in range(0, n_spw):
-        spw = str(i)
-        # if os.path.exists(f"{src_dir}/casa_files/{imagename}_{spw}_self1*"):
-        os.system(
-            f"rm -r {src_dir}/casa_files/{imagename}_{spw}_self1*"
+    thresholds = ["5e-4Jy", "5e-5Jy", "5e-6Jy"]
+    clean_pars = {
+        "gain": gain,
+        "specmode": mode,
+        "nterms": nterms,
+        "niter": niter,
+        "imsize": imsize,
+        "cell": cell,
+        "stokes": stokes,
+        "weighting": weighting,
+        "robust": robust,
+        "antenna": antenna,
+        "interactive": interactive,
+        "pbcor": False,
+        "uvrange": uvrange,
+    }
+    ledger_file = ledger.ledger_path(src_dir, imagename)
+    metrics_log = f"{src_dir}/selfcal_{imagename}.jsonl"
+    caltables = []
+    prev_ext = "preself"
+    prev_records = []
+    prev_stats = [image_stats(f"{src_dir}/casa_files/{imagename}_{spw}_preself") for spw in range(n_spw)]
+    converged = False
+    # With max_rounds=0 nothing is self calibrated and the preself images are final
+    rnd = 0
+    for rnd in range(1, max_rounds + 1):
+        print(
+            f"+ + + + + + + + + + + + + + + + +\n+  Self Cal Round {rnd}  +\n+ + + + + + + + + + + + + + + + +"
         )
-        print("Cleaning on band: " + str(spw))
-        tclean(
-            vis=imagems,
-            imagename=f"{src_dir}/casa_files/{imagename}_{spw}_self1",
-            selectdata=True,
-            mask=f"{src_dir}/casa_files/{imagename}_mfs.mask",
-            spw=spw,
-            startmodel=f"{src_dir}/casa_files/{imagename}_{spw}_preself.model",
-            gain=gain,
-            specmode=mode,
-            nterms=nterms,
-            niter=niter,
-            threshold=threshold,
-            imsize=imsize,
-            cell=cell,
-            stokes=stokes,
-            weighting=weighting,
-            robust=robust,
-            antenna=antenna,
-            interactive=interactive,
-            savemodel="modelcolumn",
-            pbcor=False,
-            uvrange=uvrange,
-        )
-        tclean(
-            vis=imagems,
-            imagename=f"{src_dir}/casa_files/{imagename}_{spw}_self1",
-            selectdata=True,
-            mask="",
-            spw=spw,
-            gain=gain,
-            specmode=mode,
-            nterms=nterms,
-            niter=0,
-            threshold=threshold,
-            imsize=imsize,
-            cell=cell,
-            stokes=stokes,
-            weighting=weighting,
-            robust=robust,
-            antenna=antenna,
-            interactive=interactive,
-            pbcor=False,
-            savemodel="modelcolumn",
-            calcres=False,
-            calcpsf=False,
-            uvrange=uvrange,
-        )
-
-    threshold = "5e-5Jy"
-    # if os.path.exists(f"{src_dir}/cal_tables/pcal2_{imagename}"):
-    rmtables(f"{src_dir}/cal_tables/pcal2_{imagename}")
-    print(
-        "+ + + + + + + + + + + + + + + + +\n+  Self Cal Round 2  +\n+ + + + + + + + + + + + + + + + +"
-    )
+        round_start = time.time()
+        # Rounds past the listed thresholds keep cleaning to the last one
+        threshold = thresholds[min(rnd, len(thresholds)) - 1]
+        caltable = f"{src_dir}/cal_tables/pcal{rnd}_{imagename}"
+        cal_pars = {
+            "caltable": caltable,
+            "gaintable": caltables,
+            "solint": solint,
+            "minsnr": minsnr,
+            "minblperant": minblperant,
+        }
+        cal_unit = f"selfcal/round{rnd}_cal"
+        cal_fp = ledger.fingerprint(cal_pars, prev_records)
+        if ledger.is_done(ledger_file, cal_unit, cal_fp) and os.path.exists(caltable):
+            print(f"Round {rnd} gains already solved and applied, skipping to imaging")
+        else:
+            # if os.path.exists(f"{src_dir}/cal_tables/pcal{rnd}_{imagename}"):
+            rmtables(caltable)
+            gaincal(
+                vis=imagems,
+                caltable=caltable,
+                gaintable=caltables,
+                combine="scan,spw",
+                spwmap=[[0] * n_spw] * len(caltables),
+                gaintype="G",
+                calmode="p",
+                solint=solint,
+                minsnr=minsnr,
+                minblperant=minblperant,
+            )
+            applycal(
+                vis=imagems,
+                gaintable=caltables + [caltable],
+                spwmap=[[0] * n_spw] * (len(caltables) + 1),
+                parang=True,
+                applymode="calonly",
+                flagbackup=False,
+            )
+            flagversions.save(imagems, f"post self{rnd}")
+            ledger.mark_done(ledger_file, cal_unit, cal_fp)
+        caltables = caltables + [caltable]
 
-    gaincal(
-        vis=imagems,
-        caltable=f"{src_dir}/cal_tables/pcal2_{imagename}",
-        gaintable=f"{src_dir}/cal_tables/pcal1_{imagename}",
-        combine="scan,spw",
-        spwmap=[0] * n_spw,
-        gaintype="G",
-        calmode="p",
-        solint=solint,
-        minsnr=minsnr,
-        minblperant=minblperant,
-    )
-    applycal(
-        vis=imagems,
-        gaintable=[
-            f"{src_dir}/cal_tables/pcal1_{imagename}",
-            f"{src_dir}/cal_tables/pcal2_{imagename}",
-        ],
-        spwmap=[[0] * n_spw, [0] * n_spw],
-        parang=True,
-        applymode="calonly",
-        flagbackup=False,
-    )
-    flagmanager(vis=imagems, mode="save", versionname="post self2")
-    for i in range(0, n_spw):
-        spw = str(i)
-        # if os.path.exists(f"{src_dir}/casa_files/{imagename}_{spw}_self2*"):
-        os.system(f"rm -r {src_dir}/casa_files/{imagename}_{spw}_self2*")
-        print("Cleaning on band: " + str(spw))
-        tclean(
-            vis=imagems,
-            imagename=f"{src_dir}/casa_files/{imagename}_{spw}_self2",
-            selectdata=True,
-            mask=f"{src_dir}/casa_files/{imagename}_mfs.mask",
-            spw=spw,
-            startmodel=f"{src_dir}/casa_files/{imagename}_{spw}_self1.model",
-            gain=gain,
-            specmode=mode,
-            nterms=nterms,
-            niter=niter,
-            threshold=threshold,
-            imsize=imsize,
-            cell=cell,
-            stokes=stokes,
-            weighting=weighting,
-            robust=robust,
-            antenna=antenna,
-            interactive=interactive,
-            savemodel="modelcolumn",
-            pbcor=False,
-            uvrange=uvrange,
-        )
-        tclean(
-            vis=imagems,
-            imagename=f"{src_dir}/casa_files/{imagename}_{spw}_self2",
-            selectdata=True,
-            mask="",
-            spw=spw,
-            gain=gain,
-            specmode=mode,
-            nterms=nterms,
-            niter=0,
-            threshold=threshold,
-            imsize=imsize,
-            cell=cell,
-            stokes=stokes,
-            weighting=weighting,
-            robust=robust,
-            antenna=antenna,
-            interactive=interactive,
-            pbcor=False,
-            savemodel="modelcolumn",
-            calcres=False,
-            calcpsf=False,
-            uvrange=uvrange,
-        )
-
-    threshold = "5e-6Jy"
-    print(
-        "+ + + + + + + + + + + + + + + + +\n+  Self Cal Round 3  +\n+ + + + + + + + + + + + + + + + +"
-    )
-
-    rmtables(f"{src_dir}/cal_tables/pcal3_{imagename}")
-    gaincal(
-        vis=imagems,
-        caltable=f"{src_dir}/cal_tables/pcal3_{imagename}",
-        gaintable=[
-            f"{src_dir}/cal_tables/pcal1_{imagename}",
-            f"{src_dir}/cal_tables/pcal2_{imagename}",
-        ],
-        combine="scan,spw",
-        spwmap=[[0] * n_spw, [0] * n_spw],
-        gaintype="G",
-        calmode="p",
-        solint=solint,
-        minsnr=minsnr,
-        minblperant=minblperant,
-    )
-    applycal(
-        vis=imagems,
-        gaintable=[
-            f"{src_dir}/cal_tables/pcal1_{imagename}",
-            f"{src_dir}/cal_tables/pcal2_{imagename}",
-            f"{src_dir}/cal_tables/pcal3_{imagename}",
-        ],
-        spwmap=[[0] * n_spw, [0] * n_spw, [0] * n_spw],
-        parang=True,
-        applymode="calonly",
-        flagbackup=False,
-    )
-    flagmanager(vis=imagems, mode="save", versionname="post self3")
-    for i in range(0, n_spw):
-        spw = str(i)
-        # if os.path.exists(f"{src_dir}/casa_files/{imagename}_{spw}_self3*"):
-        os.system(f"rm -r {src_dir}/casa_files/{imagename}_{spw}_self3*")
-        print("Cleaning on band: " + str(spw))
-        # imagename = f"{src_dir}/casa_files/{imagename}_{spw}"
-        tclean(
-            vis=imagems,
-            imagename=f"{src_dir}/casa_files/{imagename}_{spw}_self3",
-            selectdata=True,
-            mask=f"{src_dir}/casa_files/{imagename}_mfs.mask",
-            startmodel=f"{src_dir}/casa_files/{imagename}_{spw}_self2.model",
-            spw=spw,
-            gain=gain,
-            specmode=mode,
-            nterms=nterms,
-            niter=niter,
-            threshold=threshold,
-            imsize=imsize,
-            cell=cell,
-            stokes=stokes,
-            weighting=weighting,
-            robust=robust,
-            antenna=antenna,
-            interactive=interactive,
-            savemodel="modelcolumn",
-            pbcor=False,
-            uvrange=uvrange,
-        )
-        tclean(
-            vis=imagems,
-            imagename=f"{src_dir}/casa_files/{imagename}_{spw}_self3",
-            selectdata=True,
-            mask="",
-            spw=spw,
-            gain=gain,
-            specmode=mode,
-            nterms=nterms,
-            niter=0,
-            threshold=threshold,
-            imsize=imsize,
-            cell=cell,
-            stokes=stokes,
-            weighting=weighting,
-            robust=robust,
-            antenna=antenna,
-            interactive=interactive,
-            pbcor=False,
-            savemodel="modelcolumn",
-            calcres=False,
-            calcpsf=False,
-            uvrange=uvrange,
+        ext = f"self{rnd}"
+        prev_records = image_spws(
+            src_dir,
+            imagems,
+            imagename,
+            ext,
+            n_spw,
+            dict(clean_pars, threshold=threshold),
+            prev_ext=prev_ext,
+            n_workers=n_workers,
+            ledger_file=ledger_file,
+            stage="selfcal",
+            upstream=[ledger.get_record(ledger_file, cal_unit)],
         )
+        prev_ext = ext
+        stats = [image_stats(f"{src_dir}/casa_files/{imagename}_{spw}_{ext}") for spw in range(n_spw)]
+        improvement = round_improvement(prev_stats, stats)
+        converged = improvement < min_improvement
+        with open(metrics_log, "a") as log:
+            record = {
+                "round": rnd,
+                "threshold": threshold,
+                "wall_time": time.time() - round_start,
+                "improvement": improvement,
+                "converged": converged,
+                "spws": stats,
+            }
+            log.write(json.dumps(record) + "\n")
+        print(f"Self cal round {rnd}: best improvement {100 * improvement:.1f}% in {time.time() - round_start:.0f}s")
+        prev_stats = stats
+        if converged:
+            print(f"Self cal converged after round {rnd}")
+            break
+    with open(selfcal_summary_path(src_dir, imagename), "w") as summary:
+        json.dump({"rounds": rnd, "final": prev_ext, "converged": converged}, summary)
+    ledger.clear_stage(ledger_file, "selfcal")
     return
 
 
 def pbcor_ms(src_dir, targetms, ATCA_band, n_spw, tar):
+    final = final_selfcal_ext(src_dir, f"{tar}_{ATCA_band}")
     for i in range(0, n_spw):
         spw = str(i)
         imagename = f"{src_dir}/casa_files/{tar}_{ATCA_band}_{spw}"
-        os.system("rm -r " + imagename + "_self3_pbcor")
+        workspace.remove(f"{imagename}_{final}_pbcor")
         impbcor(
-            imagename=f"{imagename}_self3.image",
-            pbimage=f"{imagename}_self3.pb",
-            outfile=f"{imagename}_self3_pbcor",
+            imagename=f"{imagename}_{final}.image",
+            pbimage=workspace.locate(f"{imagename}_{final}.pb"),
+            outfile=f"{imagename}_{final}_pbcor",
             cutoff=0.1,
             overwrite=True,
         )
     return
 
 
+def source_state(vis):
+    # What a split of vis depends on: rows, last modification (FLAG edits included) and the saved flag versions
+    tbl = table(vis, ack=False)
+    nrows = tbl.nrows()
+    tbl.close()
+    version_list = f"{flagversions.store_dir(vis)}/versions.json"
+    flag_versions = ""
+    if os.path.exists(version_list):
+        with open(version_list) as versions:
+            flag_versions = hashlib.sha1(versions.read().encode()).hexdigest()
+    return {
+        "vis": os.path.abspath(vis),
+        "nrows": nrows,
+        "mtime": pipeline.newest_mtime(vis),
+        "flag_versions": flag_versions,
+    }
+
+
+def split_fitms(imagems, fitms):
+    # Reuses fitms as long as imagems hasn't changed since it was split, the state is kept next to fitms
+    state_file = f"{fitms}.source.json"
+    state = source_state(imagems)
+    if os.path.exists(fitms) and os.path.exists(state_file):
+        with open(state_file) as cached:
+            if json.load(cached) == state:
+                print(f"{fitms} is up to date with {imagems}, not splitting")
+                return
+    workspace.remove(fitms)
+    workspace.remove(state_file)
+    split(vis=imagems, datacolumn="data", outputvis=fitms)
+    listobs(
+        vis=fitms,
+        listfile=os.path.join(os.path.dirname(fitms), f"listobs_{os.path.basename(fitms)}.dat"),
+        overwrite=True,
+    )
+    # Only once the split and listobs have both worked, so a failed split is never taken as up to date
+    with open(state_file, "w") as cached:
+        json.dump(state, cached)
+    return
+
+
 def measureflux_ms(
-    src_dir, imagems, fitms, catname, ATCA_band, sourcepar, n_spw, timerange="", field="",
+    src_dir, imagems, fitms, catname, ATCA_band, sourcepar, n_spw, timerange="", field="", fitter="numpy",
 ):
-    try:
-        split(
-            vis=imagems, datacolumn="data", outputvis=fitms)
-        listobs(vis=fitms, filename=f"listobs_{fitms}.dat", overwrite=True)
-    except:
-        print("Not splitting")
+    # fitter="numpy" fits every spw in one read of fitms (see uvfit.py), "uvmodelfit" runs uvmodelfit per spw
+    split_fitms(imagems, fitms)
     int_flux_c = []
     uvrange = ""
+    ledger_file = ledger.ledger_path(src_dir, catname)
 
-    for i in range(n_spw):
-        spw = str(i)
+    if fitter == "numpy":
         # If things look like theyre not working, then check the source position! Chances are it can't find the source too far away from the phase centre
-        outfile = f"{src_dir}/casa_files/{catname}_{spw}.cl"
-        os.system(f"rm -r {outfile}")
-        uvmodelfit(
-            vis=fitms,
-            niter=15,
-            comptype="P",
-            spw=spw,
-            sourcepar=sourcepar,
-            outfile=outfile,
-            uvrange=uvrange,
-            field=field,
-            selectdata=True,
-            timerange=timerange,
+        fit = uvfit.fit_ms(fitms, sourcepar, field=field, timerange=timerange, niter=15)
+        print(
+            f"Fit offset {fit['offset'][0]:.3f}+/-{fit['offset_err'][0]:.3f}, "
+            f"{fit['offset'][1]:.3f}+/-{fit['offset_err'][1]:.3f} arcsec, reduced chi2 {fit['chi2_red']:.3g}"
         )
-        tbl = table(outfile)
-        flux = tbl.getcell("Flux", 0)[0].astype("float64")
-        int_flux_c.append(flux)
-        print(flux)
-
+        fit_fluxes = dict(zip(fit["spw"], zip(fit["flux"], fit["flux_err"])))
+        for i in range(n_spw):
+            flux, flux_err = fit_fluxes.get(i, (np.nan, np.nan))
+            int_flux_c.append(flux)
+            print(f"spw {i}: {flux} +/- {flux_err}")
+    else:
+        for i in range(n_spw):
+            spw = str(i)
+            # If things look like theyre not working, then check the source position! Chances are it can't find the source too far away from the phase centre
+            outfile = f"{src_dir}/casa_files/{catname}_{spw}.cl"
+            unit = f"measureflux/{catname}_spw{spw}"
+            fit_fp = ledger.fingerprint(
+                {
+                    "vis": fitms,
+                    "sourcepar": sourcepar,
+                    "spw": spw,
+                    "uvrange": uvrange,
+                    "field": field,
+                    "timerange": timerange,
+                    "niter": 15,
+                }
+            )
+            if ledger.is_done(ledger_file, unit, fit_fp) and os.path.exists(outfile):
+                print(f"Already fit spw {spw}, reading {outfile}")
+            else:
+                workspace.remove(outfile)
+                uvmodelfit(
+                    vis=fitms,
+                    niter=15,
+                    comptype="P",
+                    spw=spw,
+                    sourcepar=sourcepar,
+                    outfile=outfile,
+                    uvrange=uvrange,
+                    field=field,
+                    selectdata=True,
+                    timerange=timerange,
+                )
+                ledger.mark_done(ledger_file, unit, fit_fp)
+            tbl = table(outfile)
+            flux = tbl.getcell("Flux", 0)[0].astype("float64")
+            int_flux_c.append(flux)
+            print(flux)
 
     if ATCA_band == "C":
         np.savetxt(
@@ -891,6 +1128,7 @@ def measureflux_ms(
             delimiter=",",
         )
         print(int_flux_l)
+    ledger.clear_stage(ledger_file, "measureflux")
     return
 
 
@@ -1083,69 +1321,123 @@ def inspection_plots(
     return
 
 
-def export_fitspng(src_dir, n_spw, epoch, ATCA_band, tar):
-    for i in range(0, n_spw):
-        spw = str(i)
-        imagename = f"{src_dir}/casa_files/{tar}_{ATCA_band}_{spw}"
-        exportfits(
-            imagename=f"{src_dir}/casa_files/{imagename}_preself.image",
-            fitsimage=f"{src_dir}/images/{imagename}_preself.fits",
-            overwrite=True,
-        )
-        exportfits(
-            imagename=f"{src_dir}/casa_files/{imagename}_self1.image",
-            fitsimage=f"{src_dir}/images/{imagename}_self1.fits",
-            overwrite=True,
-        )
-        exportfits(
-            imagename=f"{src_dir}/casa_files/{imagename}_self2.image",
-            fitsimage=f"{src_dir}/images/{imagename}_self2.fits",
-            overwrite=True,
-        )
-        exportfits(
-            imagename=f"{src_dir}/casa_files/{imagename}_self3.image",
-            fitsimage=f"{src_dir}/images/{imagename}_self3.fits",
-            overwrite=True,
-        )
-        exportfits(
-            imagename=f"{src_dir}/casa_files/{imagename}_self3_pbcor",
-            fitsimage=f"{src_dir}/images/{imagename}_self3_pbcor.fits",
-            overwrite=True,
-        )
-        extensions = ["preself", "self1", "self2", "self3"]
-        for ext in extensions:
-            imname = f"{src_dir}/casa_files/{imagename}_{ext}.image"
-            plt.subplots(1, 1, figsize=(18, 12))
-            pix, w = buildImage(imname)
-            ax = plt.subplot(1, 1, 1, projection=w)
-            p1 = int(pix.shape[0] * 0.25)
-            p2 = int(pix.shape[0] * 0.75)
-
-            norm = simple_norm(pix[p1:p2, p1:p2].transpose(), "sqrt")
-            im = ax.imshow(
-                pix[p1:p2, p1:p2].transpose(),
-                origin="lower",
-                cmap=plt.cm.plasma,
-                norm=norm,
-            )
-            plt.colorbar(im, ax=ax)
-            ax.set_xlabel("Right Ascension", fontsize=30)
-            ax.set_ylabel("Declination", fontsize=30)
-            plt.title(f"{imagename} {ext}", fontsize=30)
-            plt.savefig(f"{src_dir}/images/{imagename}_{ext}.png")
-            plt.close()
-    mask_im = f"{src_dir}/casa_files/{tar}_{ATCA_band}_mfs.mask"
+def plot_pixels(pix, w, title, pngname, stretch="sqrt"):
+    # pix indexed [x, y] as buildImage gives it
     plt.subplots(1, 1, figsize=(18, 12))
-    pix, w = buildImage(mask_im)
     ax = plt.subplot(1, 1, 1, projection=w)
-    p1 = int(pix.shape[0] * 0.25)
-    p2 = int(pix.shape[0] * 0.75)
-
-    im = ax.imshow(pix[p1:p2, p1:p2].transpose(), origin="lower", cmap=plt.cm.plasma)
+    norm = simple_norm(pix.transpose(), stretch) if stretch else None
+    im = ax.imshow(pix.transpose(), origin="lower", cmap=plt.cm.plasma, norm=norm)
     plt.colorbar(im, ax=ax)
     ax.set_xlabel("Right Ascension", fontsize=30)
     ax.set_ylabel("Declination", fontsize=30)
-    plt.title(f"{tar} {ATCA_band} mask", fontsize=30)
-    plt.savefig(f"{src_dir}/images/{tar}_{ATCA_band}_mask.png")
+    plt.title(title, fontsize=30)
+    plt.savefig(pngname)
     plt.close()
     return
+
+
+def export_product(product):
+    # One image's FITS copy, previews and/or plot of its middle half, so it can run in a worker. With a FITS copy,
+    # the image is read once: the plot and previews come from the FITS file as it's written. Plotting only writes
+    # files, so it's done on Agg. Returns the image's entry in the preview index, if it has one.
+    plt.switch_backend("Agg")
+    blc, trc = imgio.central_window(product["source"])
+    entry = None
+    if product["fits"] is not None:
+        plane, w = write_fits(product["source"], product["fits"])
+        pix, w = imgio.cut_window(plane, w, blc, trc)
+        entry = {
+            "source": product["source"],
+            "fits": product["fits"],
+            "title": product.get("title", os.path.basename(product["fits"])),
+            "previews": imgio.write_previews(plane, product["fits"][: -len(".fits")]),
+        }
+    else:
+        pix, w = buildImage(product["source"], blc=blc, trc=trc)
+    if product["png"] is not None:
+        plot_pixels(pix, w, product["title"], product["png"], product["stretch"])
+    imgio.close(product["source"])
+    return entry
+
+
+def export_uptodate(product):
+    # Whether every output was made after the last change to the source image
+    source_time = pipeline.newest_mtime(product["source"])
+    outputs = [product[key] for key in ["fits", "png"] if product[key] is not None]
+    return source_time is not None and all(
+        os.path.exists(output) and os.path.getmtime(output) >= source_time for output in outputs
+    )
+
+
+def preview_index_path(src_dir, tar, ATCA_band):
+    return f"{src_dir}/images/{tar}_{ATCA_band}_previews.json"
+
+
+def read_preview_index(index_path):
+    # Preview index entries by FITS file
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as index:
+        return {entry["fits"]: entry for entry in json.load(index)}
+
+
+def export_fitspng(src_dir, n_spw, epoch, ATCA_band, tar, n_workers=1):
+    # FITS copies, quick look previews and plots of every spw's images, with n_workers > 1 spread over that many
+    # processes. Products already exported since their image last changed are left alone. The previews of every
+    # image are listed in {tar}_{ATCA_band}_previews.json.
+    # Every self cal round that was run, up to the one it converged on
+    final = final_selfcal_ext(src_dir, f"{tar}_{ATCA_band}")
+    rounds = 0 if final == "preself" else int(final[len("self") :])
+    extensions = ["preself"] + [f"self{rnd}" for rnd in range(1, rounds + 1)]
+    products = []
+    for i in range(0, n_spw):
+        spw = str(i)
+        imagename = f"{tar}_{ATCA_band}_{spw}"
+        for ext in extensions:
+            products.append(
+                {
+                    "source": f"{src_dir}/casa_files/{imagename}_{ext}.image",
+                    "fits": f"{src_dir}/images/{imagename}_{ext}.fits",
+                    "png": f"{src_dir}/images/{imagename}_{ext}.png",
+                    "title": f"{imagename} {ext}",
+                    "stretch": "sqrt",
+                }
+            )
+        products.append(
+            {
+                "source": f"{src_dir}/casa_files/{imagename}_{final}_pbcor",
+                "fits": f"{src_dir}/images/{imagename}_{final}_pbcor.fits",
+                "png": None,
+            }
+        )
+    products.append(
+        {
+            "source": f"{src_dir}/casa_files/{tar}_{ATCA_band}_mfs.mask",
+            "fits": None,
+            "png": f"{src_dir}/images/{tar}_{ATCA_band}_mask.png",
+            "title": f"{tar} {ATCA_band} mask",
+            "stretch": None,
+        }
+    )
+    # An image whose previews aren't in the index is exported again to make them
+    index_path = preview_index_path(src_dir, tar, ATCA_band)
+    index = read_preview_index(index_path)
+    todo = [
+        product
+        for product in products
+        if not export_uptodate(product) or (product["fits"] is not None and product["fits"] not in index)
+    ]
+    print(f"Exporting {len(todo)} of {len(products)} products, the rest are up to date")
+    if n_workers <= 1 or len(todo) <= 1:
+        entries = [export_product(product) for product in todo]
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(todo)), mp_context=ctx) as executor:
+            futures = [executor.submit(export_product, product) for product in todo]
+            entries = [future.result() for future in futures]
+    index.update({entry["fits"]: entry for entry in entries if entry is not None})
+    index = [index[product["fits"]] for product in products if product["fits"] in index]
+    with open(f"{index_path}.tmp", "w") as index_file:
+        json.dump(index, index_file, indent=1)
+    os.replace(f"{index_path}.tmp", index_path)
+    return
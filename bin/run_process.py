@@ -1,22 +1,27 @@
 #!/usr/bin/python3
-# This script calls process.py with all functions to analyse ATCA data and executes them in order, only changes needed to script should just be what stepyou need/commenting out whatever you don't need
+# This script calls process.py with all functions to analyse ATCA data and executes them in order
+# Stages are declared as a step graph (see pipeline.py), anything already up to date is skipped.
+# Choose stages with STEPS="split,calibrate" (default all) and rerun regardless with FORCE="selfcal"
+# Several targets/bands can be run at once with JOBS="J001513:C,J001513:X" (or TARGET=ALL) and MAXJOBS=4
+# PARTITION=spw (or scan) splits the target ms into shards that applycal and flagging work on SHARDWORKERS at a time
 # By K.Ross 19/5/21
 
-# TODO: introduce epoch processing 
+# TODO: introduce epoch processing
 
 # Importing relevant python packages
 import process
+import pipeline
+import shards
+import tracing
+import msio
 import os
+import json
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-data_dir = str(os.environ["PROJECT"])
-run_epoch = str(os.environ["EPOCH"])
-ATCA_band = str(os.environ["BAND"])
-tar = str(os.environ["TARGET"])
-calibrator = str(os.environ["CALIBRATOR"])
-
-print(f"Target: {tar}\nATCA band: {ATCA_band}")
-
 # Setting sourcepar dictionary to measrue flux
 source_dict = {
     "J001513": ["2327-459", (0.1, 12, -0.22), (0.5, 0, 0)],
@@ -42,71 +47,308 @@ source_dict = {
 # Defining constant variables for all sources
 ref = "CA04"
 export_pngs = True
-sec = source_dict[tar][0]
-sourcepar = source_dict[tar][1]
-src_dir = f"{data_dir}{tar}"
-visname = f"{data_dir}data/atca_2020_{ATCA_band}.ms"
-msname = f"{data_dir}data/{tar}_{ATCA_band}.ms"
-
-if ATCA_band == "L":
-    n_spw = 8
-    pri = "1934_cal_l"
-elif ATCA_band == "C":
-    n_spw = 5
-    pri = "1934_cal_cx"
-elif ATCA_band == "X":
-    pri = "1934_cal_cx"
-    n_spw = 4
-
-print("Here we go! Time to analyse some ATCA data!")
-# Uncomment whichever step you don't need to do
-# Initial flagging
-# process.flag_ms(visname)
-
-# Split to make its own ms
-# process.split_ms(
-#     src_dir,
-#     f"{src_dir}/images",
-#     visname,
-#     msname,
-#     ATCA_band,
-#     pri,
-#     sec,
-#     tar,
-#     n_spw,
-# )
-
-
-# # Calibrate, and apply cal ms using primary and secondary
-# process.calibrate_ms(src_dir, msname, ATCA_band, ref, pri, sec, tar)
-# process.applycal_ms(src_dir, msname, ATCA_band, pri, sec, tar)
-
-# # Post cal inspection and flagging
-# process.flagcal_ms(f"{src_dir}/images", msname, ATCA_band, pri, sec)
-# process.flagcaltar_ms(src_dir, msname, ATCA_band, pri, sec, tar)
-
-# process.split_imgms(data_dir, tar, "", ATCA_band, n_spw)
-imagems = f"{data_dir}data/2020_{tar}_{ATCA_band}.ms"
-imagename = f"2020-{tar}_{ATCA_band}"
-
-# # # imagems = [f"{data_dir}data/previous_processing/epoch1_L_{tar}_img.ms", f"{data_dir}data/previous_processing/epoch2_L_{tar}_img.ms", f"{data_dir}data/previous_processing/epoch3_L_{tar}_img.ms", f"{data_dir}data/previous_processing/epoch4_L_{tar}_img.ms"]
-
-# process.imgmfs_ms(src_dir, imagems, imagename, ATCA_band, n_spw)
-# process.img_ms(src_dir, imagems, imagename, ATCA_band, n_spw)
-# process.slefcal_ms(src_dir, imagems, imagename, ATCA_band, n_spw)
-process.measureflux_ms(
-    src_dir, imagems, f"{data_dir}data/2020-_{tar}_{ATCA_band}.ms", f"2020_{tar}_{ATCA_band}", ATCA_band, sourcepar, n_spw)#, field="1")
-# # process.measureflux_ms(
-# #     src_dir, imagems, f"{data_dir}data/2020_{tar}_{ATCA_band}.ms", f"2020_{tar}_{ATCA_band}", ATCA_band, sourcepar, n_spw)
-
-for epoch in ["01", "03", "04", "05"]:
-    timerange = f"2020/{epoch}/01/00:00:00~2020/{epoch}/30/23:59:59"
-    process.measureflux_ms(
-        src_dir, imagems, f"{data_dir}data/2020-_{tar}_{ATCA_band}.ms", f"2020-{epoch}_{tar}_{ATCA_band}", ATCA_band, sourcepar, n_spw, timerange=timerange)#, field="1")
+epochs = ["01", "03", "04", "05"]
+bands = ["L", "C", "X"]
+# Number of spws imaged at once within a target (IMGWORKERS), on top of however many jobs run at once
+imaging_workers = int(os.environ.get("IMGWORKERS", "1"))
+# Partitioning of the target ms after the split (see shards.py), off unless PARTITION is set
+partition_axis = os.environ.get("PARTITION", "")
+shard_workers = int(os.environ.get("SHARDWORKERS", "4"))
+# How imgmfs makes the clean mask: auto-multithresh, threshold or interactive (by hand in the viewer)
+mfs_masking = os.environ.get("MASKING", "auto-multithresh")
+
+
+def target_config(data_dir, tar, ATCA_band):
+    cfg = {
+        "data_dir": data_dir,
+        "tar": tar,
+        "ATCA_band": ATCA_band,
+        "sec": source_dict[tar][0],
+        "sourcepar": source_dict[tar][1],
+        "src_dir": f"{data_dir}{tar}",
+        "visname": f"{data_dir}data/atca_2020_{ATCA_band}.ms",
+        "msname": f"{data_dir}data/{tar}_{ATCA_band}.ms",
+        "imagems": f"{data_dir}data/2020_{tar}_{ATCA_band}.ms",
+        "imagename": f"2020-{tar}_{ATCA_band}",
+        "fitms": f"{data_dir}data/2020-_{tar}_{ATCA_band}.ms",
+    }
+    if ATCA_band == "L":
+        cfg["n_spw"] = 8
+        cfg["pri"] = "1934_cal_l"
+    elif ATCA_band == "C":
+        cfg["n_spw"] = 5
+        cfg["pri"] = "1934_cal_cx"
+    elif ATCA_band == "X":
+        cfg["pri"] = "1934_cal_cx"
+        cfg["n_spw"] = 4
+    return cfg
+
+
+def measure_epoch_fluxes(src_dir, imagems, fitms, tar, ATCA_band, sourcepar, n_spw):
+    # Each epoch's timerange spans its scans as found in the ms
+    epoch_windows = msio.epoch_windows(imagems)
+    for epoch in epochs:
+        if f"2020-{epoch}" not in epoch_windows:
+            print(f"No scans in 2020-{epoch} in {imagems}, skipping")
+            continue
+        timerange = msio.casa_timerange(*epoch_windows[f"2020-{epoch}"])
+        process.measureflux_ms(
+            src_dir, imagems, fitms, f"2020-{epoch}_{tar}_{ATCA_band}", ATCA_band, sourcepar, n_spw, timerange=timerange)#, field="1")
+    return
+
+
+def build_steps(cfg):
+    data_dir = cfg["data_dir"]
+    src_dir = cfg["src_dir"]
+    tar = cfg["tar"]
+    ATCA_band = cfg["ATCA_band"]
+    pri = cfg["pri"]
+    sec = cfg["sec"]
+    n_spw = cfg["n_spw"]
+    imagename = cfg["imagename"]
+    cal_tables = [
+        f"{src_dir}/cal_tables/cal_{pri}_{ATCA_band}.{ext}"
+        for ext in ["G0", "B0", "G1", "B1", "G2", "F0"]
+    ]
+    mfs_mask = f"{src_dir}/casa_files/{imagename}_mfs.mask"
+    spws = [str(i) for i in range(n_spw)]
+
+    steps = [
+        # Initial flagging, the raw ms is shared between targets so the stamp lives with it
+        pipeline.step(
+            "flag",
+            process.flag_ms,
+            args=(cfg["visname"],),
+            inputs=[cfg["visname"]],
+            stamp=f"{data_dir}data/steps/flag_{ATCA_band}.done",
+        ),
+        # Split to make its own ms
+        pipeline.step(
+            "split",
+            process.split_ms,
+            args=(src_dir, f"{src_dir}/images", cfg["visname"], cfg["msname"], ATCA_band, pri, sec, tar, n_spw),
+            outputs=[cfg["msname"]],
+            deps=["flag"],
+        ),
+    ]
+    if partition_axis:
+        steps.append(
+            pipeline.step("partition", shards.partition_ms, args=(cfg["msname"], partition_axis), deps=["split"])
+        )
+    steps += [
+        # Calibrate, and apply cal ms using primary and secondary
+        pipeline.step(
+            "calibrate",
+            process.calibrate_ms,
+            args=(src_dir, cfg["msname"], ATCA_band, ref, pri, sec, tar),
+            kwargs={"cache_dir": f"{data_dir}cal_cache"},
+            outputs=cal_tables,
+            deps=["partition" if partition_axis else "split"],
+        ),
+        pipeline.step(
+            "applycal",
+            process.applycal_ms,
+            args=(src_dir, cfg["msname"], ATCA_band, pri, sec, tar),
+            kwargs={"n_workers": shard_workers},
+            inputs=cal_tables,
+            deps=["calibrate"],
+        ),
+        # Post cal inspection and flagging
+        pipeline.step(
+            "flagcal",
+            process.flagcal_ms,
+            args=(f"{src_dir}/images", cfg["msname"], ATCA_band, pri, sec, tar),
+            kwargs={"n_workers": shard_workers},
+            deps=["applycal"],
+        ),
+        pipeline.step(
+            "flagcaltar",
+            process.flagcaltar_ms,
+            args=(src_dir, cfg["msname"], ATCA_band, pri, sec, tar),
+            kwargs={"n_workers": shard_workers},
+            deps=["flagcal"],
+        ),
+        # Imaging and self cal all happen in place on the image ms, so they are chained by their stamps
+        pipeline.step(
+            "imgmfs",
+            process.imgmfs_ms,
+            args=(src_dir, cfg["imagems"], imagename, ATCA_band, n_spw),
+            kwargs={"masking": mfs_masking},
+            outputs=[mfs_mask],
+            deps=["flagcaltar"],
+        ),
+        pipeline.step(
+            "img",
+            process.img_ms,
+            args=(src_dir, cfg["imagems"], imagename, ATCA_band, n_spw),
+            kwargs={"n_workers": imaging_workers},
+            inputs=[mfs_mask],
+            outputs=[f"{src_dir}/casa_files/{imagename}_{spw}_preself.image" for spw in spws],
+            deps=["imgmfs"],
+        ),
+        pipeline.step(
+            "selfcal",
+            process.slefcal_ms,
+            args=(src_dir, cfg["imagems"], imagename, ATCA_band, n_spw),
+            kwargs={"n_workers": imaging_workers},
+            outputs=[process.selfcal_summary_path(src_dir, imagename)],
+            deps=["img"],
+        ),
+        pipeline.step(
+            "measureflux",
+            process.measureflux_ms,
+            args=(src_dir, cfg["imagems"], cfg["fitms"], f"2020_{tar}_{ATCA_band}", ATCA_band, cfg["sourcepar"], n_spw),
+            outputs=[f"{src_dir}/2020_{tar}_{ATCA_band}.csv"],
+            deps=["selfcal"],
+        ),
+        pipeline.step(
+            "measureflux_epochs",
+            measure_epoch_fluxes,
+            args=(src_dir, cfg["imagems"], cfg["fitms"], tar, ATCA_band, cfg["sourcepar"], n_spw),
+            outputs=[f"{src_dir}/2020-{epoch}_{tar}_{ATCA_band}.csv" for epoch in epochs],
+            deps=["selfcal"],
+        ),
+    ]
+    return steps
+
+
+def run_target(data_dir, tar, ATCA_band, selected=None, force=()):
+    print(f"Target: {tar}\nATCA band: {ATCA_band}")
+    cfg = target_config(data_dir, tar, ATCA_band)
+    for sub_dir in ["casa_files", "cal_tables", "images"]:
+        os.makedirs(f"{cfg['src_dir']}/{sub_dir}", exist_ok=True)
+    steps = build_steps(cfg)
+    tracing.set_trace_file(f"{cfg['src_dir']}/trace_{tar}_{ATCA_band}.jsonl", f"{tar}_{ATCA_band}")
+    print("Here we go! Time to analyse some ATCA data!")
+    return pipeline.run_steps(
+        steps, f"{cfg['src_dir']}/steps/{ATCA_band}", selected=selected, force=force
+    )
+
+
+def run_job(data_dir, tar, ATCA_band, scratch_root, selected=None, force=()):
+    # Runs in a worker process: CASA drops logs and *.last files in the working directory, so give every job its own
+    from casatasks import casalog
+
+    scratch_dir = f"{scratch_root}/{tar}_{ATCA_band}"
+    os.makedirs(scratch_dir, exist_ok=True)
+    os.chdir(scratch_dir)
+    casalog.setlogfile(f"{scratch_dir}/casa_{tar}_{ATCA_band}.log")
+    start = time.time()
+    result = {"target": tar, "band": ATCA_band, "scratch_dir": scratch_dir}
+    try:
+        rerun = run_target(data_dir, tar, ATCA_band, selected=selected, force=force)
+        result["status"] = "success"
+        result["steps_run"] = sorted(rerun)
+    except Exception as err:
+        result["status"] = "failed"
+        result["error"] = f"{type(err).__name__}: {err}"
+        result["traceback"] = traceback.format_exc()
+    result["wall_time"] = time.time() - start
+    return result
+
+
+def run_batch(data_dir, jobs, max_workers=2, scratch_root=None, selected=None, force=()):
+    # jobs: list of (target, band) pairs, each one runs the full step graph in its own process
+    if scratch_root is None:
+        scratch_root = f"{data_dir}processing/scratch"
+    os.makedirs(scratch_root, exist_ok=True)
+    start = time.time()
+    results = []
+    # Every target of a band is split out of the same raw ms, so flag that once per band before fanning out
+    if selected is None or "flag" in selected:
+        for ATCA_band in sorted(set(band for _, band in jobs)):
+            tar = next(src for src, band in jobs if band == ATCA_band)
+            run_target(data_dir, tar, ATCA_band, selected=["flag"], force=force)
+    worker_steps = [
+        stp["name"] for stp in build_steps(target_config(data_dir, jobs[0][0], jobs[0][1]))
+    ]
+    worker_steps = [name for name in (selected or worker_steps) if name != "flag"]
+    # spawn rather than fork so every worker starts CASA from scratch
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as executor:
+        futures = {
+            executor.submit(run_job, data_dir, tar, ATCA_band, scratch_root, worker_steps, force): (tar, ATCA_band)
+            for tar, ATCA_band in jobs
+        }
+        for future in as_completed(futures):
+            tar, ATCA_band = futures[future]
+            try:
+                result = future.result()
+            except Exception as err:
+                # The worker itself died (e.g. CASA segfault), rather than the job raising
+                result = {
+                    "target": tar,
+                    "band": ATCA_band,
+                    "status": "failed",
+                    "error": f"{type(err).__name__}: {err}",
+                    "wall_time": float("nan"),
+                }
+            print(f"{tar} {ATCA_band}: {result['status']} in {result['wall_time']:.1f}s")
+            results.append(result)
+
+    summary = {
+        "wall_time": time.time() - start,
+        "max_workers": max_workers,
+        "n_success": sum(res["status"] == "success" for res in results),
+        "n_failed": sum(res["status"] == "failed" for res in results),
+        "jobs": sorted(results, key=lambda res: (res["target"], res["band"])),
+    }
+    print_batch_summary(summary)
+    # Where the time went, across every job in the batch
+    trace_files = [
+        f"{data_dir}{tar}/trace_{tar}_{ATCA_band}.jsonl"
+        for tar, ATCA_band in jobs
+        if os.path.exists(f"{data_dir}{tar}/trace_{tar}_{ATCA_band}.jsonl")
+    ]
+    summary["hot_steps"] = tracing.summarize(trace_files, since=start)
+    tracing.print_summary(summary["hot_steps"])
+    with open(f"{scratch_root}/batch_summary.json", "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    # Every target's previews in one place, for looking over the whole batch
+    previews = []
+    for tar, ATCA_band in jobs:
+        index_path = process.preview_index_path(f"{data_dir}{tar}", tar, ATCA_band)
+        if os.path.exists(index_path):
+            with open(index_path) as index:
+                previews.append({"target": tar, "band": ATCA_band, "images": json.load(index)})
+    with open(f"{scratch_root}/batch_previews.json", "w") as previews_file:
+        json.dump(previews, previews_file, indent=1)
+    return summary
+
+
+def print_batch_summary(summary):
+    print("+ + + + + + + + + + + + + + + + +\n+  Batch summary  +\n+ + + + + + + + + + + + + + + + +")
+    for res in summary["jobs"]:
+        line = f"{res['target']:>12} {res['band']}  {res['status']:>7}  {res['wall_time']:10.1f}s"
+        if res["status"] == "failed":
+            line += f"  {res['error']}"
+        print(line)
+    print(
+        f"{summary['n_success']} succeeded, {summary['n_failed']} failed, "
+        f"total wall time {summary['wall_time']:.1f}s with {summary['max_workers']} workers"
+    )
+    return
+
+
+def parse_jobs(jobs_env, tar, ATCA_band):
+    # "J001513:C,J015445:X" -> [("J001513", "C"), ("J015445", "X")], a job without a band runs all three
+    if tar == "ALL" and not jobs_env:
+        return [(src, band) for src in source_dict for band in bands]
+    jobs = []
+    for job in jobs_env.split(","):
+        if not job:
+            continue
+        if ":" in job:
+            src, band = job.split(":")
+            jobs.append((src, band))
+        else:
+            jobs.extend((job, band) for band in bands)
+    return jobs
+
 
 # if run_epoch == "TRUE":
+#     process.split_imgms_epochs(data_dir, tar, ATCA_band, n_spw)
 #     for epoch in ["01", "03", "04", "05"]:
-#         process.split_imgms(data_dir, tar, epoch, ATCA_band, n_spw)
 #         imagems = f"2020-{epoch}_{tar}_{ATCA_band}.ms"
 #         imagename = f"2020-{epoch}_{tar}_{ATCA_band}"
 #         process.imgmfs_ms(src_dir, imagems, imagename, ATCA_band, n_spw)
@@ -116,7 +358,6 @@ for epoch in ["01", "03", "04", "05"]:
 #             src_dir, imagems, f"2020-{epoch}_{tar}_{ATCA_band}_postscal.ms", f"2020-{epoch}_{tar}_{ATCA_band}", ATCA_band, sourcepar, n_spw)
 
 
-
 # Post image analysis: pbcor, measure flux
 # process.pbcor_ms(src_dir, targetms, ATCA_band, n_spw, tar)
 
@@ -128,3 +369,26 @@ for epoch in ["01", "03", "04", "05"]:
 #     )
 # process.export_fitspng(src_dir, n_spw, epoch, ATCA_band, tar)
 
+
+if __name__ == "__main__":
+    data_dir = str(os.environ["PROJECT"])
+    run_epoch = str(os.environ["EPOCH"])
+    ATCA_band = str(os.environ["BAND"])
+    tar = str(os.environ["TARGET"])
+    calibrator = str(os.environ["CALIBRATOR"])
+    steps_env = os.environ.get("STEPS", "")
+    selected = [s for s in steps_env.split(",") if s] or None
+    force = [s for s in os.environ.get("FORCE", "").split(",") if s]
+    jobs = parse_jobs(os.environ.get("JOBS", ""), tar, ATCA_band)
+
+    if jobs:
+        run_batch(
+            data_dir,
+            jobs,
+            max_workers=int(os.environ.get("MAXJOBS", "2")),
+            scratch_root=os.environ.get("SCRATCH") or None,
+            selected=selected,
+            force=force,
+        )
+    else:
+        run_target(data_dir, tar, ATCA_band, selected=selected, force=force)
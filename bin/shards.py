@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# Optional partitioning of a target's ms into a multi-MS (one sub-ms per spw or per scan, under SUBMSS/), so the
+# flagging and applycal steps can work on the shards side by side in worker processes. The multi-MS keeps
+# the name of the ms it replaces and reads and writes like one ms (a virtual concatenation of the shards), so
+# anything that doesn't know about shards carries on as before and the results of the shards recombine by
+# themselves. Set PARTITION=spw (or scan) for run_process.py to partition after the split.
+
+import os
+import glob
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from casacore.tables import table
+from casatasks import partition
+import tracing
+import flagplan
+import flagversions
+import msio
+
+partition = tracing.traced(partition)
+
+
+def is_mms(vis):
+    return os.path.isdir(f"{vis}/SUBMSS")
+
+
+def shard_paths(vis):
+    # The sub-mss of a multi-MS, or just vis if it's a plain ms
+    if not is_mms(vis):
+        return [vis]
+    return sorted(glob.glob(f"{vis}/SUBMSS/*.ms"))
+
+
+def partition_ms(vis, separationaxis="spw", numsubms="auto"):
+    # Rewrites vis as a multi-MS in place, each shard holding one spw (or scan) group
+    if is_mms(vis):
+        print(f"{vis} is already partitioned")
+        return
+    outputvis = f"{vis}.partitioned"
+    shutil.rmtree(outputvis, ignore_errors=True)
+    partition(
+        vis=vis,
+        outputvis=outputvis,
+        createmms=True,
+        separationaxis=separationaxis,
+        numsubms=numsubms,
+        datacolumn="all",
+        flagbackup=False,
+    )
+    # The multi-MS refers to its shards relative to itself, so it can take the ms's place
+    shutil.rmtree(vis)
+    os.replace(outputvis, vis)
+    print(f"Partitioned {vis} into {len(shard_paths(vis))} shards by {separationaxis}")
+    # The rows are in a different order now, so the saved flag versions no longer line up with them
+    shutil.rmtree(flagversions.store_dir(vis), ignore_errors=True)
+    flagversions.save(vis, "after_partition", comment="flag versions from before partitioning were dropped")
+    return
+
+
+def has_rows(shard, field=""):
+    # Whether a CASA field selection picks any rows of the shard. A shard split by scan can hold no rows of a field,
+    # and applycal then fails with MSSelectionNullSelection.
+    ids = msio.field_ids(shard, field)
+    if ids is None:
+        return True
+    t = table(shard, ack=False)
+    present = set(t.getcol("FIELD_ID").tolist())
+    t.close()
+    return bool(present & set(ids))
+
+
+def map_shards(func, vis, *args, n_workers=1, **kwargs):
+    # func(shard, *args, **kwargs) for every shard of vis, up to n_workers at a time in separate processes.
+    # func has to be a module level function so it can be sent to the workers. Returns the results in shard order.
+    paths = shard_paths(vis)
+    if n_workers <= 1 or len(paths) == 1:
+        return [func(shard, *args, **kwargs) for shard in paths]
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(paths)), mp_context=ctx) as executor:
+        futures = [executor.submit(func, shard, *args, **kwargs) for shard in paths]
+        return [future.result() for future in futures]
+
+
+def run_plan_shard(shard, plan, engine):
+    # Only the commands that select something in this shard
+    commands = [dict(cmd, vis=shard) for cmd in plan["commands"] if has_rows(shard, cmd.get("field", ""))]
+    if not commands:
+        return []
+    return flagplan.run(dict(plan, commands=commands), engine)
+
+
+def run_plan(plan, engine="casa", n_workers=1):
+    # A flag plan for one ms, run on each of its shards at once if it's a multi-MS
+    vises = {cmd["vis"] for cmd in plan["commands"]}
+    if len(vises) != 1 or not is_mms(next(iter(vises))):
+        return flagplan.run(plan, engine)
+    return map_shards(run_plan_shard, vises.pop(), plan, engine, n_workers=n_workers)
@@ -1,6 +1,201 @@
 import plot_nearby
+import pipeline
+import uvfit
+import flagging
+import flagversions
+import imgio
+import tracing
+import shutil
+import numpy as np
+from casacore.tables import table
+import os
+import time
 
 
 def test_mwafluxes():
     # Need to find the actual fluxes ot change the 0 to
     assert(plot_nearby.read_MWA_fluxes("/data/MWA/", "J001513", "GLEAM J001513-472706")) == 0
+
+
+def test_pipeline_skips_uptodate(tmp_path):
+    calls = []
+    raw = tmp_path / "raw.ms"
+    raw.mkdir()
+    (raw / "table.f0").write_text("data")
+    product = tmp_path / "product.ms"
+
+    def make_product():
+        calls.append("split")
+        product.mkdir(exist_ok=True)
+
+    def use_product():
+        calls.append("calibrate")
+
+    steps = [
+        pipeline.step("split", make_product, inputs=[str(raw)], outputs=[str(product)]),
+        pipeline.step("calibrate", use_product, deps=["split"]),
+    ]
+    pipeline.run_steps(steps, str(tmp_path / "steps"))
+    pipeline.run_steps(steps, str(tmp_path / "steps"))
+    assert calls == ["split", "calibrate"]
+
+    # Touching the raw data should rerun split and everything downstream of it
+    later = time.time() + 10
+    os.utime(raw / "table.f0", (later, later))
+    pipeline.run_steps(steps, str(tmp_path / "steps"))
+    assert calls == ["split", "calibrate", "split", "calibrate"]
+
+
+def make_point_ms(vis, flux, offset):
+    # Two spws of a point source of flux Jy offset (x, y) arcsec from the phase centre, put in by sm.predict
+    from casatools import simulator, measures, componentlist
+
+    me = measures()
+    sm = simulator()
+    cl = componentlist()
+    sm.open(vis)
+    sm.setconfig(
+        telescopename="ATCA",
+        x=[0.0, 30.6, 91.8, 153.0, 306.0, 2000.0],
+        y=np.zeros(6),
+        z=np.zeros(6),
+        dishdiameter=np.full(6, 22.0),
+        mount="alt-az",
+        antname=[f"CA0{i + 1}" for i in range(6)],
+        coordsystem="local",
+        referencelocation=me.observatory("ATCA"),
+    )
+    for i, freq in enumerate(["5.0GHz", "6.0GHz"]):
+        sm.setspwindow(
+            spwname=f"s{i}", freq=freq, deltafreq="32MHz", freqresolution="32MHz", nchannels=4, stokes="XX XY YX YY"
+        )
+    sm.setfield(sourcename="tar", sourcedirection=me.direction("J2000", "05h00m00s", "-60d00m00s"))
+    sm.setfeed(mode="perfect X Y")
+    sm.setlimits(shadowlimit=0.0, elevationlimit="0deg")
+    sm.setauto(autocorrwt=0.0)
+    sm.settimes(integrationtime="10s", usehourangle=True, referencetime=me.epoch("utc", "2020/01/01"))
+    for start in [-14400, -7200, 0, 7200]:
+        for spw in ["s0", "s1"]:
+            sm.observe("tar", spw, starttime=f"{start}s", stoptime=f"{start + 600}s")
+    ra = 75.0 + offset[0] / 3600.0 / np.cos(np.radians(-60.0))
+    dec = -60.0 + offset[1] / 3600.0
+    cl.addcomponent(dir=f"J2000 {ra}deg {dec}deg", flux=flux, fluxunit="Jy", freq="5.5GHz", shape="point")
+    cl.rename(f"{vis}.cl")
+    cl.close()
+    sm.predict(complist=f"{vis}.cl")
+    sm.close()
+    return vis
+
+
+def test_uvfit_point_source(tmp_path):
+    # uvmodelfit finds 0.5 Jy at (3.0, -2.0) on the same data
+    vis = make_point_ms(str(tmp_path / "point.ms"), 0.5, (3.0, -2.0))
+    fit = uvfit.fit_ms(vis, [0.4, 2.5, -1.5])
+    assert np.allclose(fit["flux"], [0.5, 0.5], atol=1e-3)
+    assert np.allclose(fit["offset"], [3.0, -2.0], atol=1e-2)
+
+
+def test_lightcurve_point_source(tmp_path):
+    # A steady 0.5 Jy source, every bin with data in it should come out at 0.5 Jy with the offset free or fixed
+    vis = make_point_ms(str(tmp_path / "point.ms"), 0.5, (3.0, -2.0))
+    for vary_offset in [True, False]:
+        curve = uvfit.lightcurve_ms(vis, interval=60.0, sourcepar=[0.4, 2.5, -1.5], vary_offset=vary_offset)
+        flux = curve["flux"][np.isfinite(curve["flux"])]
+        assert len(flux) >= 40
+        assert np.allclose(flux, 0.5, atol=1e-3)
+
+
+def test_preview_levels_skip_nans():
+    pix = np.arange(36.0).reshape(6, 6)
+    pix[0, 0] = np.nan
+    levels = imgio.preview_levels(pix, [3, 2, 1])
+    assert [level.shape for level in levels] == [(3, 3), (2, 2), (1, 1)]
+    assert np.isclose(levels[0][0, 0], (1 + 6 + 7) / 3)
+    # Padding at the edges mustn't count towards the averages
+    assert np.isclose(levels[-1][0, 0], np.nanmean(pix))
+
+
+def test_traced_task_without_name(tmp_path, monkeypatch):
+    # Like the casatasks, a callable object with no __name__
+    class _listobs:
+        def __call__(self, vis=""):
+            return vis
+
+    monkeypatch.setenv(tracing.trace_env, str(tmp_path / "trace.jsonl"))
+    assert tracing.traced(_listobs())(vis="a.ms") == "a.ms"
+    assert tracing.read_trace(str(tmp_path / "trace.jsonl"))[0]["task"] == "listobs"
+
+
+def make_shadowed_ms(vis):
+    # Compact array watching a source low in the south, so the northern antennas are shadowed for part of the time
+    from casatools import simulator, measures
+
+    me = measures()
+    sm = simulator()
+    sm.open(vis)
+    sm.setconfig(
+        telescopename="ATCA",
+        x=[0.0, 0.0, 0.0, 30.6, 61.2, 200.0],
+        y=[0.0, 24.0, 48.0, 0.0, 0.0, 0.0],
+        z=np.zeros(6),
+        dishdiameter=np.full(6, 22.0),
+        mount="alt-az",
+        antname=[f"CA0{i + 1}" for i in range(6)],
+        coordsystem="local",
+        referencelocation=me.observatory("ATCA"),
+    )
+    sm.setspwindow(
+        spwname="cx", freq="5.5GHz", deltafreq="64MHz", freqresolution="64MHz", nchannels=4, stokes="XX XY YX YY"
+    )
+    sm.setfield(sourcename="tar", sourcedirection=me.direction("J2000", "05h00m00s", "-70d00m00s"))
+    sm.setfeed(mode="perfect X Y")
+    sm.setlimits(shadowlimit=0.0, elevationlimit="0deg")
+    sm.setauto(autocorrwt=0.0)
+    sm.settimes(integrationtime="4s", usehourangle=True, referencetime=me.epoch("utc", "2020/01/01"))
+    for start in [-36000, -30000, -3600]:
+        sm.observe("tar", "cx", starttime=f"{start}s", stoptime=f"{start + 120}s")
+    sm.close()
+    # Noise with a sprinkling of zeros and NaNs, and no flags yet
+    t = table(vis, readonly=False, ack=False)
+    rng = np.random.default_rng(2)
+    shape = t.getcol("DATA").shape
+    data = rng.standard_normal(shape) + 1j * rng.standard_normal(shape)
+    data[rng.random(shape) < 0.01] = 0
+    data[rng.random(shape) < 0.005] = np.nan
+    t.putcol("DATA", data)
+    t.putcol("FLAG", np.zeros(shape, dtype=bool))
+    t.putcol("FLAG_ROW", np.zeros(shape[0], dtype=bool))
+    t.close()
+    return vis
+
+
+def test_online_flags_match_flagdata(tmp_path):
+    from casatasks import flagdata
+
+    casa_ms = make_shadowed_ms(str(tmp_path / "casa.ms"))
+    numpy_ms = str(tmp_path / "numpy.ms")
+    shutil.copytree(casa_ms, numpy_ms)
+    flagdata(vis=casa_ms, mode="shadow", tolerance=0.0, flagbackup=False)
+    flagdata(vis=casa_ms, mode="clip", clipzeros=True, flagbackup=False)
+    flagdata(vis=casa_ms, mode="quack", quackinterval=5.0, quackmode="beg", flagbackup=False)
+    flagging.online_flags(numpy_ms, tolerance=0.0, clipzeros=True, quackinterval=5.0)
+    for col in ["FLAG", "FLAG_ROW"]:
+        expected = table(casa_ms, ack=False).getcol(col)
+        assert expected.any()
+        assert np.array_equal(table(numpy_ms, ack=False).getcol(col), expected)
+
+
+def test_flagversions_roundtrip(tmp_path):
+    vis = make_shadowed_ms(str(tmp_path / "flags.ms"))
+    flagversions.save(vis, "before")
+    before = table(vis, ack=False).getcol("FLAG")
+    flagging.online_flags(vis)
+    flagversions.save(vis, "after")
+    after = table(vis, ack=False).getcol("FLAG")
+    assert flagversions.read_index(vis)[-1]["base"] == "before"
+    flagversions.restore(vis, "before")
+    assert np.array_equal(table(vis, ack=False).getcol("FLAG"), before)
+    # Deleting the version "after" was saved against mustn't lose it
+    flagversions.delete(vis, "before")
+    flagversions.restore(vis, "after")
+    assert np.array_equal(table(vis, ack=False).getcol("FLAG"), after)
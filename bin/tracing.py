@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+# Timing and resource trace for the CASA task calls in process.py
+# Every wrapped task appends one json line (wall/cpu time, peak rss, bytes read/written, arguments) to the
+# trace file of the current target/band. Run this script on a set of traces to rank the hot steps, e.g.
+# python3 tracing.py /data/ATCA/ATCA_datareduction/*/trace_*.jsonl
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+import contextlib
+
+# Kept in the environment so worker processes spawned by process.py write to the same trace
+trace_env = "PIPELINE_TRACE"
+label_env = "PIPELINE_TRACE_LABEL"
+rss_poll_interval = 0.5
+# Step names set by stage(), for tasks called from a helper module on behalf of a process.py step
+stage_names = []
+
+
+def set_trace_file(path, label=""):
+    os.environ[trace_env] = path
+    os.environ[label_env] = label
+    return
+
+
+def read_io():
+    # Bytes actually hitting storage, only available on linux
+    try:
+        with open("/proc/self/io") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def read_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def watch_rss(peak, done):
+    # ru_maxrss is the peak over the whole process, so sample while the task runs to get its own peak
+    while not done.wait(rss_poll_interval):
+        peak[0] = max(peak[0], read_rss())
+    return
+
+
+def json_safe(value):
+    try:
+        json.dumps(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+@contextlib.contextmanager
+def stage(name):
+    # Calls traced inside the with block are recorded under step name rather than the calling function
+    stage_names.append(name)
+    try:
+        yield
+    finally:
+        stage_names.pop()
+
+
+def task_name(task):
+    # casatasks are instances of a class named after the task (_flagdata), plain functions have a __name__
+    return getattr(task, "__name__", type(task).__name__.lstrip("_"))
+
+
+def traced(task):
+    name = task_name(task)
+
+    @functools.wraps(task)
+    def wrapper(*args, **kwargs):
+        trace_file = os.environ.get(trace_env)
+        if not trace_file:
+            return task(*args, **kwargs)
+        # Name of the process.py function making the call, e.g. slefcal_ms
+        step = stage_names[-1] if stage_names else sys._getframe(1).f_code.co_name
+        peak = [read_rss()]
+        done = threading.Event()
+        watcher = threading.Thread(target=watch_rss, args=(peak, done), daemon=True)
+        read_start, write_start = read_io()
+        cpu_start = time.process_time()
+        wall_start = time.time()
+        watcher.start()
+        status = "ok"
+        try:
+            return task(*args, **kwargs)
+        except Exception as err:
+            status = f"{type(err).__name__}: {err}"
+            raise
+        finally:
+            wall_time = time.time() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            done.set()
+            watcher.join()
+            read_end, write_end = read_io()
+            record = {
+                "label": os.environ.get(label_env, ""),
+                "step": step,
+                "task": name,
+                "start": wall_start,
+                "wall_time": wall_time,
+                "cpu_time": cpu_time,
+                "peak_rss": max(peak[0], read_rss()),
+                "read_bytes": read_end - read_start,
+                "write_bytes": write_end - write_start,
+                "status": status,
+                "pid": os.getpid(),
+                "args": [json_safe(arg) for arg in args],
+                "kwargs": {key: json_safe(val) for key, val in kwargs.items()},
+            }
+            # One short append per call, so several processes can share a trace
+            with open(trace_file, "a") as trace:
+                trace.write(json.dumps(record) + "\n")
+
+    return wrapper
+
+
+def read_trace(path):
+    records = []
+    with open(path) as trace:
+        for line in trace:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def summarize(trace_files, since=0.0):
+    # Totals per (step, task) across every trace given, sorted with the most wall time first
+    # Traces are appended to on every run, since: only count calls started after this time
+    totals = {}
+    for path in trace_files:
+        for rec in read_trace(path):
+            if rec["start"] < since:
+                continue
+            key = (rec["step"], rec["task"])
+            tot = totals.setdefault(
+                key,
+                {
+                    "step": rec["step"],
+                    "task": rec["task"],
+                    "calls": 0,
+                    "wall_time": 0.0,
+                    "cpu_time": 0.0,
+                    "peak_rss": 0,
+                    "read_bytes": 0,
+                    "write_bytes": 0,
+                },
+            )
+            tot["calls"] += 1
+            tot["wall_time"] += rec["wall_time"]
+            tot["cpu_time"] += rec["cpu_time"]
+            tot["peak_rss"] = max(tot["peak_rss"], rec["peak_rss"])
+            tot["read_bytes"] += rec["read_bytes"]
+            tot["write_bytes"] += rec["write_bytes"]
+    return sorted(totals.values(), key=lambda tot: tot["wall_time"], reverse=True)
+
+
+def print_summary(summary):
+    total_wall = sum(tot["wall_time"] for tot in summary) or 1.0
+    print(
+        f"{'step':>16} {'task':>12} {'calls':>6} {'wall [h]':>9} {'%':>6} {'cpu [h]':>9} "
+        f"{'peak rss [GB]':>14} {'read [GB]':>10} {'write [GB]':>11}"
+    )
+    for tot in summary:
+        print(
+            f"{tot['step']:>16} {tot['task']:>12} {tot['calls']:>6} {tot['wall_time'] / 3600:>9.2f} "
+            f"{100 * tot['wall_time'] / total_wall:>6.1f} {tot['cpu_time'] / 3600:>9.2f} "
+            f"{tot['peak_rss'] / 1e9:>14.2f} {tot['read_bytes'] / 1e9:>10.2f} {tot['write_bytes'] / 1e9:>11.2f}"
+        )
+    return
+
+
+if __name__ == "__main__":
+    print_summary(summarize(sys.argv[1:]))
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+# Point source fits straight from the visibilities, used by measureflux_ms instead of one uvmodelfit per spw
+# The ms is read once in row chunks and reduced to Stokes I averaged into a few channel bins per spw, then the
+# flux in every spw (or every time bin, for lightcurves) is fit along with the position offset by Gauss-Newton
+# least squares.
+
+import numpy as np
+from casacore.tables import table
+import msio
+
+arcsec = np.pi / (180.0 * 3600.0)
+c = 299792458.0
+# Parallel hands making up Stokes I: XX/YY for ATCA, RR/LL in case anything circular comes through
+stokes_i_corrs = [(9, 12), (5, 8)]
+# Channel bins per spw, plenty to keep bandwidth smearing negligible for a source near the phase centre
+chan_bins = 8
+
+
+def ddid_setup(vis):
+    # For each DATA_DESC_ID: spw id, channel frequencies and the indices of the two parallel hands
+    dd = table(f"{vis}/DATA_DESCRIPTION", ack=False)
+    spw_ids = dd.getcol("SPECTRAL_WINDOW_ID")
+    pol_ids = dd.getcol("POLARIZATION_ID")
+    dd.close()
+    spw = table(f"{vis}/SPECTRAL_WINDOW", ack=False)
+    pol = table(f"{vis}/POLARIZATION", ack=False)
+    setup = []
+    for spw_id, pol_id in zip(spw_ids, pol_ids):
+        corr_types = list(pol.getcell("CORR_TYPE", pol_id))
+        hands = [pair for pair in stokes_i_corrs if all(corr in corr_types for corr in pair)]
+        if not hands:
+            raise ValueError(f"No parallel hands in {vis} polarization {pol_id} to make Stokes I from")
+        setup.append(
+            {
+                "spw": int(spw_id),
+                "freqs": spw.getcell("CHAN_FREQ", spw_id),
+                "hands": [corr_types.index(corr) for corr in hands[0]],
+            }
+        )
+    spw.close()
+    pol.close()
+    return setup
+
+
+def stokes_i(data, flag, weight, hands):
+    # (XX+YY)/2 and its weight 1/var = 4/(1/w_XX + 1/w_YY), a channel only counts if both hands are unflagged
+    a, b = hands
+    vis = 0.5 * (data[:, :, a] + data[:, :, b])
+    with np.errstate(divide="ignore"):
+        wt = 4.0 / (1.0 / weight[:, a] + 1.0 / weight[:, b])
+    wt = np.where(flag[:, :, a] | flag[:, :, b], 0.0, wt[:, None])
+    return vis, wt
+
+
+def average_bins(vis, wt, freqs, nbins=chan_bins):
+    # Weighted mean over groups of adjacent channels, the weight of a bin being the sum of its channel weights
+    starts = np.array([chans[0] for chans in np.array_split(np.arange(len(freqs)), min(nbins, len(freqs)))])
+    wsum = np.add.reduceat(wt, starts, axis=1)
+    vsum = np.add.reduceat(vis * wt, starts, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vis_avg = np.where(wsum > 0, vsum / wsum, 0.0)
+    freq_avg = np.add.reduceat(freqs, starts) / np.diff(np.append(starts, len(freqs)))
+    return vis_avg, wsum, freq_avg
+
+
+def read_stokes_i(vis, field="", timerange="", datacolumn=None, nbins=chan_bins, extra=""):
+    # One pass over the ms. Returns the unflagged Stokes I samples: spw, time, u and v in wavelengths, vis, weight
+    # Like uvmodelfit, the corrected data are used if there are any unless datacolumn says otherwise
+    # extra: any further TaQL row selection
+    setup = ddid_setup(vis)
+    t = table(vis, ack=False)
+    if datacolumn is None:
+        datacolumn = "CORRECTED_DATA" if "CORRECTED_DATA" in t.colnames() else "DATA"
+    columns = [datacolumn, "FLAG", "WEIGHT", "UVW", "TIME", "DATA_DESC_ID"]
+    extra = " && ".join(cond for cond in [msio.timerange_query(vis, timerange), extra] if cond)
+    parts = {key: [] for key in ["spw", "time", "u", "v", "vis", "weight"]}
+    for sub, start, nrow, cols in msio.iter_chunks(t, vis, columns, field=msio.field_ids(vis, field), extra=extra):
+        for ddid in np.unique(cols["DATA_DESC_ID"]):
+            rows = cols["DATA_DESC_ID"] == ddid
+            dd = setup[ddid]
+            vis_i, wt = stokes_i(cols[datacolumn][rows], cols["FLAG"][rows], cols["WEIGHT"][rows], dd["hands"])
+            vis_avg, wt_avg, freq_avg = average_bins(vis_i, wt, dd["freqs"], nbins)
+            uvw = cols["UVW"][rows]
+            good = wt_avg > 0
+            parts["spw"].append(np.full(good.sum(), dd["spw"]))
+            parts["time"].append(np.broadcast_to(cols["TIME"][rows][:, None], good.shape)[good])
+            parts["u"].append((uvw[:, 0:1] * freq_avg / c)[good])
+            parts["v"].append((uvw[:, 1:2] * freq_avg / c)[good])
+            parts["vis"].append(vis_avg[good])
+            parts["weight"].append(wt_avg[good])
+    t.close()
+    if not parts["vis"]:
+        raise ValueError(f"Nothing selected from {vis} with field={field} timerange={timerange}")
+    return {key: np.concatenate(val) for key, val in parts.items()}
+
+
+def solve_point(samples, flux_idx, nflux, pos_idx, npos, sourcepar, niter=15, tol=1e-4):
+    # Fits V = S_f exp(2 pi i (u l_p + v m_p)) where each sample belongs to flux group f and position group p,
+    # e.g. a flux per spw and one shared position, or a flux and position per time bin. All groups of the same
+    # kind are solved together, so a thousand time bins cost about as much as one.
+    u = 2 * np.pi * samples["u"]
+    v = 2 * np.pi * samples["v"]
+    vis = samples["vis"]
+    w = samples["weight"]
+    wsum = np.bincount(flux_idx, w, nflux)
+    offset = np.tile(np.array(sourcepar[1:3], dtype=float) * arcsec, (npos, 1))
+    flux = np.full(nflux, float(sourcepar[0]))
+    pos_normal = np.zeros((npos, 2, 2))
+    for it in range(niter):
+        # Shifting the data to the current position leaves S plus noise, so the fluxes are a weighted mean
+        rot = vis * np.exp(-1j * (u * offset[pos_idx, 0] + v * offset[pos_idx, 1]))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            flux = np.bincount(flux_idx, w * rot.real, nflux) / wsum
+        res = rot - flux[flux_idx]
+        # Position steps from the normal equations, the fluxes don't couple to them at the linearisation point
+        ws2 = w * flux[flux_idx] ** 2
+        wsi = w * flux[flux_idx] * res.imag
+        pos_normal[:, 0, 0] = np.bincount(pos_idx, ws2 * u * u, npos)
+        pos_normal[:, 0, 1] = pos_normal[:, 1, 0] = np.bincount(pos_idx, ws2 * u * v, npos)
+        pos_normal[:, 1, 1] = np.bincount(pos_idx, ws2 * v * v, npos)
+        grad = np.stack([np.bincount(pos_idx, wsi * u, npos), np.bincount(pos_idx, wsi * v, npos)], axis=1)
+        # pinv rather than solve so a group with no signal just stops moving
+        step = np.nan_to_num((np.linalg.pinv(pos_normal) @ grad[:, :, None])[:, :, 0])
+        offset = offset + step
+        if np.all(np.abs(step) < tol * arcsec):
+            break
+    rot = vis * np.exp(-1j * (u * offset[pos_idx, 0] + v * offset[pos_idx, 1]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        flux = np.bincount(flux_idx, w * rot.real, nflux) / wsum
+    res = rot - flux[flux_idx]
+    # Scatter about the fit sets the noise level, the weights only need to be right relative to each other.
+    # Two real numbers per sample, less a flux and (at most) a position per group.
+    chi2 = w * np.abs(res) ** 2
+    nsamples = np.bincount(flux_idx, minlength=nflux)
+    chi2_red = np.bincount(flux_idx, chi2, nflux) / np.maximum(2 * nsamples - 3, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        flux_err = np.sqrt(chi2_red / wsum)
+    pos_chi2 = np.bincount(pos_idx, chi2, npos) / np.maximum(2 * np.bincount(pos_idx, minlength=npos) - 3, 1)
+    pos_cov = pos_chi2[:, None, None] * np.linalg.pinv(pos_normal)
+    return {
+        "flux": flux,
+        "flux_err": flux_err,
+        "offset": offset / arcsec,
+        "offset_err": np.sqrt(np.abs(np.diagonal(pos_cov, axis1=1, axis2=2))) / arcsec,
+        "chi2_red": chi2_red,
+        "niter": it + 1,
+        "nsamples": nsamples,
+    }
+
+
+def fit_point(samples, sourcepar, niter=15, tol=1e-4):
+    # A flux per spw and one position offset shared by all of them.
+    # sourcepar is uvmodelfit's [flux (Jy), x offset (arcsec), y offset (arcsec)] and is used as the starting point.
+    spws, idx = np.unique(samples["spw"], return_inverse=True)
+    fit = solve_point(samples, idx, len(spws), np.zeros(len(idx), int), 1, sourcepar, niter, tol)
+    fit["spw"] = spws
+    fit["offset"] = fit["offset"][0]
+    fit["offset_err"] = fit["offset_err"][0]
+    # One noise level over everything, as the position is shared
+    chi2 = np.sum(fit["chi2_red"] * np.maximum(2 * fit["nsamples"] - 3, 1))
+    fit["chi2_red"] = chi2 / max(2 * np.sum(fit["nsamples"]) - len(spws) - 2, 1)
+    fit["flux_err"] = np.sqrt(fit["chi2_red"] / np.bincount(idx, samples["weight"], len(spws)))
+    return fit
+
+
+def time_bins(times, interval, starts=None):
+    # Bin index of each sample (-1 if it's in none) and the bin start times. Bins are [start, start + interval],
+    # either at the given starts or every interval from the first sample.
+    # Bins keep the order of starts, they don't need to be sorted.
+    if starts is None:
+        starts = times.min() + interval * np.arange(int((times.max() - times.min()) // interval) + 1)
+    starts = np.asarray(starts, dtype=float)
+    order = np.argsort(starts, kind="stable")
+    idx = np.searchsorted(starts[order], times, side="right") - 1
+    inside = (idx >= 0) & (times <= starts[order][np.maximum(idx, 0)] + interval)
+    return np.where(inside, order[np.maximum(idx, 0)], -1), starts
+
+
+def fit_lightcurve(samples, interval, starts=None, sourcepar=(1.0, 0.0, 0.0), vary_offset=True, niter=10):
+    # Flux in every time bin from one vectorized solve, all spws together like an unselected uvmodelfit.
+    # vary_offset=False fits one position over all bins, which holds up better when the bins are noisy.
+    idx, starts = time_bins(samples["time"], interval, starts)
+    keep = idx >= 0
+    samples = {key: val[keep] for key, val in samples.items()}
+    idx = idx[keep]
+    nbins = len(starts)
+    if vary_offset:
+        fit = solve_point(samples, idx, nbins, idx, nbins, sourcepar, niter)
+    else:
+        fit = solve_point(samples, idx, nbins, np.zeros(len(idx), int), 1, sourcepar, niter)
+    fit["start"] = starts
+    fit["interval"] = interval
+    return fit
+
+
+def fit_ms(vis, sourcepar, field="", timerange="", datacolumn=None, niter=15):
+    return fit_point(read_stokes_i(vis, field=field, timerange=timerange, datacolumn=datacolumn), sourcepar, niter)
+
+
+def lightcurve_ms(vis, interval=30.0, starts=None, sourcepar=(1.0, 0.0, 0.0), field="", datacolumn=None, **kwargs):
+    # starts: bin start times in MJD seconds, defaults to every interval from the first integration
+    # Given starts, only the rows from the first bin to the end of the last are read
+    extra = ""
+    if starts is not None:
+        extra = f"TIME >= {float(np.min(starts))!r} && TIME <= {float(np.max(starts)) + interval!r}"
+    samples = read_stokes_i(vis, field=field, datacolumn=datacolumn, extra=extra)
+    return fit_lightcurve(samples, interval, starts=starts, sourcepar=sourcepar, **kwargs)
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# Handles the files process.py makes along the way: deleting old products in-process (instead of shelling out to rm -r)
+# and keeping the bulky imaging intermediates (.psf, .residual, .pb, .sumwt) on a fast local scratch disk.
+# Set STAGING=/some/local/disk to turn staging on, otherwise everything is written in place as before.
+
+import os
+import glob
+import shutil
+
+staging_env = "STAGING"
+# Products of a tclean run that belong in {src_dir}/casa_files, everything else stays on scratch
+final_exts = [".image", ".model", ".mask"]
+
+
+def remove(pattern):
+    # Deletes whatever matches the glob pattern, files or table directories, and is quiet if nothing does
+    for path in glob.glob(pattern):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return
+
+
+def staging_root():
+    return os.environ.get(staging_env) or None
+
+
+def staged(path):
+    # Scratch location standing in for a final path, mirrors the full path so targets can't collide
+    root = staging_root()
+    if root is None:
+        return path
+    staged_path = f"{root}/{os.path.abspath(path).lstrip('/')}"
+    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    return staged_path
+
+
+def locate(path):
+    # Where a product actually is: its staged copy if there is one, otherwise the final location
+    staged_path = staged(path)
+    if staged_path != path and os.path.exists(staged_path):
+        return staged_path
+    return path
+
+
+def remove_product(prefix):
+    # Clears every {prefix}* product, both on scratch and in the final location
+    remove(f"{prefix}*")
+    if staged(prefix) != prefix:
+        remove(f"{staged(prefix)}*")
+    return
+
+
+def promote(prefix, exts=None):
+    # Moves the final products of {prefix} (e.g. .image, .model.tt0) from scratch to where they belong
+    staged_prefix = staged(prefix)
+    if staged_prefix == prefix:
+        return
+    if exts is None:
+        exts = final_exts
+    for ext in exts:
+        for staged_path in glob.glob(f"{staged_prefix}{ext}*"):
+            final_path = prefix + staged_path[len(staged_prefix):]
+            remove(final_path)
+            shutil.move(staged_path, final_path)
+    return
+
+
+def copy_products(src_prefix, dst_prefix, exts):
+    # Copies the {src_prefix}{ext}* products (e.g. .psf, .psf.tt0), wherever they are, to where a clean of
+    # dst_prefix writes them
+    for ext in exts:
+        root = staged(src_prefix) if glob.glob(f"{staged(src_prefix)}{ext}*") else src_prefix
+        for path in glob.glob(f"{root}{ext}*"):
+            dst_path = staged(dst_prefix) + path[len(root) :]
+            remove(dst_path)
+            shutil.copytree(path, dst_path)
+    return